@@ -0,0 +1,154 @@
+'''
+Render pivot chart views without a bokeh server, from widget configurations like those produced by
+"Export Config to URL" (the decoded 'widgets' parameter of the URL).
+
+Usage:
+    python batch.py views.json [--data csv/source.csv] [--out batch_out] [--format html|json] [--workers 4] [--ncols 3]
+
+views.json holds a list of widget configurations, or one configuration per line. Each view uses the 'data' source of
+its configuration, or --data if it has none, and may have a 'name' used for its output file (default view_<number>).
+Each view is written to <out>/<name>.html (standalone page) or <out>/<name>.json (bokeh json_item for embedding),
+and the time taken by each view is printed and written to <out>/report.json.
+
+Views are computed in parallel by a pool of processes. Data sources are loaded into srccache before the pool
+starts, so on platforms that fork, workers share the loaded sources rather than each loading its own copy.
+'''
+from __future__ import division
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+import concurrent.futures
+import bokeh.layouts as bl
+import bokeh.embed as be
+import bokeh.resources as br
+
+import main
+
+def read_configs(path):
+    '''
+    Read widget configurations from a json file holding a list of them, or one per line.
+    '''
+    with open(path) as f:
+        text = f.read()
+    try:
+        configs = json.loads(text)
+    except ValueError:
+        configs = [json.loads(line) for line in text.splitlines() if line.strip() != '']
+    return configs if isinstance(configs, list) else [configs]
+
+def view_jobs(configs, data, out, fmt, ncols):
+    '''
+    Return one job tuple for render_view() per widget configuration.
+    '''
+    jobs = []
+    for i, config in enumerate(configs):
+        data_source = str(config.get('data', data) or '')
+        if data_source == '':
+            raise ValueError('View %d has no data source, and no --data was given' % i)
+        name = str(config.get('name', 'view_%03d' % i))
+        jobs.append((i, name, data_source, config, out, fmt, ncols))
+    return jobs
+
+def render_view(job):
+    '''
+    Compute the figures of one view and write them to a file, reusing the app's pivot and figure functions
+    with widgets that are built but never shown.
+
+    Args:
+        job (tuple): (index, name, data source, widget configuration, output directory, format, columns of figures).
+
+    Returns:
+        report (dict): Name, output path, numbers of rows and figures, and seconds spent loading (load_s),
+            pivoting (pivot_s), building figures (figures_s), and writing (write_s).
+    '''
+    i, name, data_source, config, out, fmt, ncols = job
+    timings = {}
+    start = time.time()
+    df_source, cols = main.get_data(data_source)
+    timings['load'] = time.time() - start
+
+    start = time.time()
+    wdg = main.build_widgets(df_source, cols, init_load=True, init_config=config)
+    if wdg['x'].value == 'None' or wdg['y'].value == 'None':
+        raise ValueError('View %s needs x and y' % name)
+    df_plots = main.set_df_plots(df_source, cols, wdg)
+    timings['pivot'] = time.time() - start
+
+    start = time.time()
+    figs = main.create_figures(df_plots, wdg, cols)
+    layout = bl.gridplot(figs, ncols=ncols, toolbar_location='right') if figs else bl.column([])
+    timings['figures'] = time.time() - start
+
+    start = time.time()
+    path = os.path.join(out, name + '.' + fmt)
+    if fmt == 'html':
+        title = wdg['plot_title'].value or name
+        text = be.file_html(layout, br.CDN, title)
+    else:
+        text = json.dumps(be.json_item(layout, name))
+    with open(path, 'w') as f:
+        f.write(text)
+    timings['write'] = time.time() - start
+
+    report = {'index': i, 'name': name, 'path': path, 'rows': len(df_plots), 'figures': len(figs)}
+    report.update(dict((k + '_s', round(v, 4)) for k, v in timings.items()))
+    report['total_s'] = round(sum(timings.values()), 4)
+    return report
+
+def run(jobs, workers):
+    '''
+    Preload each distinct data source once, then render all views over a process pool.
+
+    Returns:
+        reports (list): Report of each view from render_view(), in order, or with an 'error' for views that failed.
+    '''
+    for data_source in sorted(set(job[2] for job in jobs)):
+        main.get_data(data_source)
+    kwargs = {'max_workers': workers}
+    if sys.version_info >= (3, 7) and 'fork' in multiprocessing.get_all_start_methods():
+        kwargs['mp_context'] = multiprocessing.get_context('fork')
+    reports = [None] * len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(**kwargs) as executor:
+        futures = dict((executor.submit(render_view, job), job) for job in jobs)
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                reports[job[0]] = future.result()
+            except Exception as e:
+                reports[job[0]] = {'index': job[0], 'name': job[1], 'error': str(e)}
+    return reports
+
+def print_reports(reports):
+    '''
+    Print a table of the time taken by each view.
+    '''
+    print('%-24s %8s %5s %8s %8s %8s %8s %8s' % ('view', 'rows', 'figs', 'load', 'pivot', 'figures', 'write', 'total'))
+    for r in reports:
+        if 'error' in r:
+            print('%-24s error: %s' % (r['name'], r['error']))
+        else:
+            print('%-24s %8d %5d %7.3fs %7.3fs %7.3fs %7.3fs %7.3fs' % (r['name'], r['rows'], r['figures'],
+                r['load_s'], r['pivot_s'], r['figures_s'], r['write_s'], r['total_s']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render pivot chart views from widget configurations')
+    parser.add_argument('configs', help='json file with a list of widget configurations, or one per line')
+    parser.add_argument('--data', default='', help='data source for views whose configuration has none')
+    parser.add_argument('--out', default='batch_out', help='output directory')
+    parser.add_argument('--format', default='html', choices=['html', 'json'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() if hasattr(os, 'cpu_count') else 4)
+    parser.add_argument('--ncols', type=int, default=3, help='figures per row of exploded charts')
+    args = parser.parse_args()
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    jobs = view_jobs(read_configs(args.configs), args.data, args.out, args.format, args.ncols)
+    start = time.time()
+    reports = run(jobs, args.workers)
+    print_reports(reports)
+    print('%d views in %.3fs' % (len(reports), time.time() - start))
+    with open(os.path.join(args.out, 'report.json'), 'w') as f:
+        json.dump(reports, f, indent=2)
+    sys.exit(1 if any('error' in r for r in reports) else 0)
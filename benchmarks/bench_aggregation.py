@@ -0,0 +1,61 @@
+'''
+Benchmark the y-axis aggregations of set_df_plots on synthetic data.
+
+Usage:
+    python benchmarks/bench_aggregation.py [--rows 10000000] [--groups 5000] [--legacy]
+
+--legacy also times the old groupby.apply(wavg) weighted average, which is very slow on large frames.
+'''
+from __future__ import division
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import main
+
+def make_df(rows, groups, seed=0):
+    rng = np.random.RandomState(seed)
+    n_a = max(int(groups ** 0.5), 1)
+    n_b = max(groups // n_a, 1)
+    return pd.DataFrame({
+        'a': pd.Categorical.from_codes(rng.randint(0, n_a, rows), ['a%d' % i for i in range(n_a)]),
+        'b': rng.randint(0, n_b, rows),
+        'y': rng.randn(rows),
+        'w': rng.rand(rows),
+    })
+
+def wavg(group, avg_name, weight_name):
+    #The weighted average that set_df_plots used to apply to each group
+    d = group[avg_name]
+    w = group[weight_name]
+    try:
+        return (d * w).sum() / w.sum()
+    except ZeroDivisionError:
+        return 0
+
+def timeit(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+def main_bench(args):
+    df = make_df(args.rows, args.groups)
+    cols = {'continuous': ['b', 'y', 'w']}
+    print('rows: %d, groups: %d' % (len(df), df.groupby(['a', 'b'], observed=True).ngroups))
+    for agg in main.AGGREGATIONS[1:]:
+        elapsed, result = timeit(lambda: main.aggregate_y(df, ['a', 'b'], 'y', agg, 'w', cols))
+        print('%-20s %8.3fs' % (agg, elapsed))
+    if args.legacy:
+        elapsed, result = timeit(lambda: df.groupby(['a', 'b'], sort=False, observed=True).apply(wavg, 'y', 'w'))
+        print('%-20s %8.3fs' % ('Weighted Ave (apply)', elapsed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark y-axis aggregations')
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--groups', type=int, default=5000)
+    parser.add_argument('--legacy', action='store_true')
+    main_bench(parser.parse_args())
@@ -0,0 +1,135 @@
+'''
+Benchmark the pivot engine end to end on synthetic sources (see synth.py): loading, each stage of set_df_plots,
+figure_specs, figure creation, and encoding glyph data for the browser, for each chart type with and without
+series, explode, x_group and comparisons. Peak traced memory of each case is measured in a separate run,
+since tracing slows everything down.
+
+Usage:
+    python benchmarks/bench_pivot.py [--rows 10000 100000 1000000] [--repeat 3] [--out results.json]
+        [--cases Bar_series ...] [--gdx file.gdx>param] [--no-memory]
+
+Results are written as json, with the commit and package versions, for comparison with compare.py.
+Generated csv sources are kept in --data-dir (a temporary directory by default) and reused by later runs.
+'''
+from __future__ import division
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+import pandas as pd
+import bokeh
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import main
+import pivotprof
+import synth
+
+Y = 'value'
+BASE_CASES = [
+    ('plain', {'x': 'year', 'y': Y}),
+    ('series', {'x': 'year', 'y': Y, 'series': 'technology'}),
+    ('explode', {'x': 'year', 'y': Y, 'series': 'technology', 'explode': 'region'}),
+    ('explode_group', {'x': 'year', 'y': Y, 'series': 'technology', 'explode': 'region', 'explode_group': 'scenario'}),
+    ('x_group', {'x': 'technology', 'y': Y, 'x_group': 'region', 'series': 'scenario'}),
+    ('adv_op', {'x': 'year', 'y': Y, 'series': 'technology', 'adv_op': 'Difference', 'adv_col': 'scenario', 'adv_col_base': 'Reference'}),
+    ('hourly', {'x': 'hour', 'y': Y, 'series': 'technology', 'explode': 'scenario'}),
+]
+CASES = [(chart_type + '_' + name, dict(config, chart_type=chart_type))
+    for chart_type in main.CHARTTYPES for name, config in BASE_CASES]
+
+def run_case(df_source, cols, config):
+    '''
+    Run one view through the pipeline, as update_plots() does, and return its profile from pivotprof.
+    '''
+    profile = {'label': 'bench', 'stages': [], 'start': time.time()}
+    wdg = main.snapshot_widgets(main.build_widgets(df_source, cols, init_load=True, init_config=config))
+    df_plots = main.set_df_plots(df_source, cols, wdg, profile=profile)
+    specs = pivotprof.stage(profile, 'figure_specs', main.figure_specs, df_plots, wdg, cols)
+    pivotprof.stage(profile, 'create_figures', lambda specs: [main.create_figure(spec, wdg, cols) for spec in specs], specs)
+    main.profile_serialization(profile, specs)
+    profile['seconds'] = time.time() - profile['start']
+    return profile
+
+def time_case(df_source, cols, config, repeat):
+    '''
+    Return the best time of each stage, and of the whole case, over repeat runs, with the rows out of each stage.
+    '''
+    best = {}
+    rows = {}
+    for r in range(repeat):
+        profile = run_case(df_source, cols, config)
+        for entry in profile['stages'] + [{'stage': 'total', 'seconds': profile['seconds'], 'rows_out': None}]:
+            best[entry['stage']] = min(best.get(entry['stage'], float('inf')), entry['seconds'])
+            rows[entry['stage']] = entry['rows_out']
+    return best, rows
+
+def peak_memory(func, *args):
+    '''
+    Return the peak traced memory in MB while calling func(*args).
+    '''
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)))
+        return out.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main_bench(args):
+    results = []
+    cases = [c for c in CASES if not args.cases or c[0] in args.cases]
+    for rows in args.rows:
+        path = synth.source_csv(rows, args.data_dir)
+        start = time.time()
+        df_source, cols = main.load_data(path)
+        load_s = time.time() - start
+        load_mb = None if args.no_memory else peak_memory(main.load_data, path)
+        results.append({'rows': rows, 'case': 'load', 'stage': 'total', 'seconds': load_s, 'peak_mb': load_mb})
+        print('%10d %-24s %8.3fs' % (rows, 'load', load_s))
+        for name, config in cases:
+            best, stage_rows = time_case(df_source, cols, config, args.repeat)
+            mem = None if args.no_memory else peak_memory(run_case, df_source, cols, config)
+            for stage in best:
+                results.append({'rows': rows, 'case': name, 'stage': stage, 'seconds': best[stage], 'rows_out': stage_rows[stage],
+                    'peak_mb': mem if stage == 'total' else None})
+            print('%10d %-24s %8.3fs %s' % (rows, name, best['total'], '' if mem is None else '%8.1f MB' % mem))
+    if args.gdx:
+        import gdxl
+        gdx_path, param = args.gdx.split('>')
+        best = min(timed(gdxl.get_df, gdx_path, param) for r in range(args.repeat))
+        results.append({'rows': None, 'case': 'gdxl.get_df', 'stage': 'total', 'seconds': best, 'peak_mb': None})
+        print('%10s %-24s %8.3fs' % ('', 'gdxl.get_df', best))
+    meta = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+        'pandas': pd.__version__, 'numpy': np.__version__, 'bokeh': bokeh.__version__, 'repeat': args.repeat}
+    with open(args.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print('wrote ' + args.out)
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pivot engine on synthetic data')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+        help='source sizes, up to tens of millions of rows')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cases', nargs='*', help='names of cases to run (default all): ' + ', '.join(c[0] for c in CASES))
+    parser.add_argument('--gdx', help='also time gdxl.get_df on a gdx file and parameter, separated by >')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'superpivot_bench'))
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    main_bench(parser.parse_args())
@@ -0,0 +1,165 @@
+'''
+Check that the vectorized aggregations (aggregate_y) and comparisons (compare_df) of set_df_plots give the same
+results as straightforward groupby/apply implementations, like the ones they replaced, on small synthetic frames.
+
+Usage:
+    python benchmarks/check_equivalence.py [--rows 2000] [--seed 0]
+
+Exits with status 1 if any case differs.
+
+The reference results follow the documented changes of the rewrite: Weighted Ave is 0 for groups whose weights sum
+to 0 (the old wavg gave NaN), Ratio with a Consecutive base divides by the previous value (it used to return the
+difference), and groups without the base value are dropped (they used to be compared with their first row).
+'''
+from __future__ import division
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import main
+
+REFERENCE_AGGS = {
+    'Sum': np.sum, 'Ave': np.mean, 'Min': np.min, 'Max': np.max, 'Median': np.median, 'Count': len,
+    '10th Percentile': lambda v: np.percentile(v, 10), '25th Percentile': lambda v: np.percentile(v, 25),
+    '75th Percentile': lambda v: np.percentile(v, 75), '90th Percentile': lambda v: np.percentile(v, 90),
+}
+
+def make_df(rows, seed=0):
+    '''
+    Return a frame like the result of the aggregate stage: one row per (case, region, year), with a float and an
+    integer y column and a weight column. Some regions have zero weights, and case 'c3' is missing from region 'r0'.
+    '''
+    rng = np.random.RandomState(seed)
+    cases = ['c%d' % i for i in range(4)]
+    regions = ['r%d' % i for i in range(max(rows // 40, 2))]
+    years = [2010, 2020, 2030, 2040, 2050]
+    df = pd.DataFrame([(c, r, yr) for r in regions for c in cases for yr in years], columns=['case', 'region', 'year'])
+    df = df[~((df['case'] == 'c3') & (df['region'] == 'r0'))]
+    df = df.sample(frac=1, random_state=rng).reset_index(drop=True)
+    df['case'] = pd.Categorical(df['case'], categories=cases)
+    df['region'] = pd.Categorical(df['region'], categories=regions)
+    df['y'] = rng.randn(len(df)) * 10 + 50
+    df['y_int'] = rng.randint(1, 100, len(df))
+    df['w'] = rng.rand(len(df))
+    df.loc[df['region'].isin(regions[:2]), 'w'] = 0
+    return df
+
+def wavg(group, avg_name, weight_name):
+    #The weighted average that set_df_plots used to apply to each group
+    d = group[avg_name]
+    w = group[weight_name]
+    try:
+        return (d * w).sum() / w.sum()
+    except ZeroDivisionError:
+        return 0
+
+def reference_aggregate(df, groupby_cols, y, agg, weight):
+    df_grouped = df.groupby(groupby_cols, sort=False, observed=True)
+    if agg == 'Weighted Ave':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ser = df_grouped[[y, weight]].apply(wavg, y, weight)
+        w_sums = df_grouped[weight].sum()
+        ser[w_sums.reindex(ser.index).values == 0] = 0
+    else:
+        ser = df_grouped[y].apply(lambda v: REFERENCE_AGGS[agg](v.values))
+    return ser.rename(y).reset_index()
+
+def reference_compare(df, col, y, op, base):
+    '''
+    Compare y across col by applying a function to each group of rows that match on all other columns,
+    with the rows of each group in order of first appearance of col values (the base value first, for operations
+    that use a base).
+    '''
+    col_list = df[col].unique().tolist()
+    if base in col_list and op not in main.ADV_OPS_NO_BASE:
+        col_list.remove(base)
+        col_list = [base] + col_list
+    df = df.copy()
+    df['tempsort'] = df[col].map(lambda x: col_list.index(x)).astype(int)
+    df = df.sort_values('tempsort', kind='mergesort').reset_index(drop=True)
+    groupcols = [c for c in df.columns if c not in [col, y, 'tempsort']]
+
+    def compare_group(g):
+        vals = g[y].astype(float)
+        if op == 'Cumulative Sum':
+            return vals.cumsum()
+        if op == 'Share of Total':
+            return vals / vals.sum()
+        if base == 'Consecutive':
+            bases = vals.shift()
+        elif base == 'Total':
+            bases = pd.Series(vals.sum(), index=vals.index)
+        elif (g[col] == base).any():
+            bases = pd.Series(vals[g[col] == base].iloc[0], index=vals.index)
+        else:
+            bases = pd.Series(np.nan, index=vals.index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if op == 'Difference':
+                return vals - bases
+            elif op == 'Ratio':
+                return vals / bases
+            return (vals - bases) / bases * 100
+
+    results = [compare_group(g) for key, g in df.groupby(groupcols, sort=False, observed=True)]
+    df[y] = pd.concat(results).reindex(df.index)
+    if op not in main.ADV_OPS_NO_BASE:
+        df = df[~df[col].isin([base])]
+    return df[pd.notnull(df[y])].drop('tempsort', axis='columns')
+
+def same(expected, actual, keys, y):
+    '''
+    Return True if two frames have the same rows, in any order, and y values that are close.
+    '''
+    if len(expected) != len(actual):
+        return False
+    expected = expected.astype({k: str for k in keys}).sort_values(keys).reset_index(drop=True)
+    actual = actual.astype({k: str for k in keys}).sort_values(keys).reset_index(drop=True)
+    if not (expected[keys] == actual[keys]).all().all():
+        return False
+    return np.allclose(expected[y].values.astype(float), actual[y].values.astype(float), rtol=1e-9, atol=1e-9, equal_nan=True)
+
+def check_aggregations(df):
+    failures = []
+    cols = {'continuous': ['year', 'y', 'y_int', 'w']}
+    for groupby_cols in [['region'], ['case', 'region', 'year']]:
+        for y in ['y', 'y_int']:
+            for agg in main.AGGREGATIONS[1:]:
+                expected = reference_aggregate(df, groupby_cols, y, agg, 'w')
+                actual = main.aggregate_y(df, groupby_cols, y, agg, 'w', cols)
+                if not same(expected, actual, groupby_cols, y):
+                    failures.append('aggregate %s of %s by %s' % (agg, y, groupby_cols))
+    return failures
+
+def check_comparisons(df):
+    failures = []
+    cols = {'continuous': ['year', 'y', 'y_int', 'w']}
+    df = df.drop('w', axis='columns')
+    cases = [('case', 'c0'), ('case', 'c3'), ('case', 'Consecutive'), ('case', 'Total'),
+        ('year', '2020'), ('year', 'Consecutive'), ('year', 'Total')]
+    for y in ['y', 'y_int']:
+        df_y = df.drop('y_int' if y == 'y' else 'y', axis='columns')
+        for op in main.ADV_OPS[1:]:
+            for col, base in cases:
+                wdg = {'adv_op': op, 'adv_col': col, 'adv_col_base': base, 'y': y, 'y_agg': 'Sum'}
+                wdg = dict((k, main.WidgetState(v, None)) for k, v in wdg.items())
+                ref_base = int(base) if col == 'year' and base not in main.ADV_BASES else base
+                expected = reference_compare(df_y, col, y, op, ref_base)
+                actual = main.compare_df(df_y, cols, wdg)
+                if not same(expected, actual, ['case', 'region', 'year'], y):
+                    failures.append('compare %s of %s across %s (base %s)' % (op, y, col, base))
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check vectorized aggregations and comparisons against groupby/apply')
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    df = make_df(args.rows, args.seed)
+    failures = check_aggregations(df) + check_comparisons(df)
+    for failure in failures:
+        print('DIFFERENT: ' + failure)
+    print('%d rows, %d cases differ' % (len(df), len(failures)))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,45 @@
+'''
+Check that the data sources shared between sessions by srccache are read-only: writing to any column of a cached
+frame, through df[col].values or .loc, must raise rather than change the data every other session sees.
+
+Usage:
+    python benchmarks/check_readonly.py [--data csv/US_electric_power_generation.csv]
+
+Exits with status 1 if any column can be written.
+'''
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import main
+
+def writable_columns(df):
+    '''
+    Return the columns of df that can be written to in place, and restore the values of any that could.
+    '''
+    writable = []
+    for col in df.columns:
+        for how in ['values', 'loc']:
+            try:
+                if how == 'values':
+                    vals = df[col].values
+                    vals[0] = vals[len(vals) - 1]
+                else:
+                    df.loc[df.index[0], col] = df[col].iloc[len(df) - 1]
+            except (ValueError, TypeError):
+                continue
+            writable.append('%s (%s)' % (col, how))
+    return writable
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that cached data sources are read-only')
+    parser.add_argument('--data', default=os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+        'csv', 'US_electric_power_generation.csv'))
+    args = parser.parse_args()
+    df_source, cols = main.get_data(args.data)
+    writable = writable_columns(df_source)
+    for col in writable:
+        print('WRITABLE: ' + col)
+    print('%d columns, %d writable' % (len(df_source.columns), len(writable)))
+    sys.exit(1 if writable else 0)
@@ -0,0 +1,53 @@
+'''
+Compare two results files from bench_pivot.py, e.g. from two commits, and list the timings that changed.
+
+Usage:
+    python benchmarks/compare.py base.json new.json [--threshold 1.2] [--min-seconds 0.005] [--all]
+
+Exits with status 1 if any timing of at least --min-seconds got slower by more than --threshold times.
+'''
+from __future__ import division
+import sys
+import json
+import argparse
+
+def load_results(path):
+    with open(path) as f:
+        data = json.load(f)
+    results = dict(((r['rows'], r['case'], r['stage']), r) for r in data['results'])
+    return data['meta'], results
+
+def compare(base, new, threshold, min_seconds):
+    '''
+    Return (key, base seconds, new seconds, ratio, is regression) for each timing in both results.
+    '''
+    rows = []
+    for key in sorted(set(base) & set(new), key=lambda k: (k[0] or 0, k[1], k[2])):
+        b = base[key]['seconds']
+        n = new[key]['seconds']
+        ratio = n / b if b > 0 else float('inf')
+        regression = ratio > threshold and max(b, n) >= min_seconds
+        rows.append((key, b, n, ratio, regression))
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two bench_pivot.py results files')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    parser.add_argument('--min-seconds', type=float, default=0.005, help='ignore timings faster than this in both files')
+    parser.add_argument('--all', action='store_true', help='list all timings, not only changes beyond the threshold')
+    args = parser.parse_args()
+    base_meta, base = load_results(args.base)
+    new_meta, new = load_results(args.new)
+    print('base: %s (%s)' % (base_meta.get('commit'), base_meta.get('time')))
+    print('new:  %s (%s)' % (new_meta.get('commit'), new_meta.get('time')))
+    rows = compare(base, new, args.threshold, args.min_seconds)
+    print('%10s %-24s %-16s %10s %10s %7s' % ('rows', 'case', 'stage', 'base', 'new', 'ratio'))
+    for (n_rows, case, stage), b, n, ratio, regression in rows:
+        changed = max(b, n) >= args.min_seconds and (ratio > args.threshold or ratio < 1 / args.threshold)
+        if args.all or changed:
+            print('%10s %-24s %-16s %9.4fs %9.4fs %6.2fx%s' % (n_rows, case, stage, b, n, ratio, '  SLOWER' if regression else ''))
+    n_regressions = sum(1 for r in rows if r[4])
+    print('%d timings compared, %d slower than %.2fx' % (len(rows), n_regressions, args.threshold))
+    sys.exit(1 if n_regressions else 0)
@@ -0,0 +1,71 @@
+'''
+Synthetic data sources for benchmarks, with the shape of typical model output: every combination of scenario,
+region, technology (and its type) and year, over as many hours as are needed to reach the requested number of rows,
+with a numeric value column.
+
+Usage:
+    python benchmarks/synth.py 1000000 out.csv [--seed 0]
+'''
+from __future__ import division
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+SCENARIOS = ['Reference', 'Carbon Tax', 'High Demand', 'Low Cost Renewables']
+REGIONS = ['Region %02d' % i for i in range(10)]
+TECHNOLOGIES = ['Coal', 'Natural Gas CC', 'Natural Gas CT', 'Nuclear', 'Hydropower', 'Wind Onshore', 'Wind Offshore',
+    'Solar PV', 'Solar CSP', 'Geothermal', 'Biomass', 'Storage']
+TECH_TYPES = ['Non-Renewable', 'Non-Renewable', 'Non-Renewable', 'Non-Renewable', 'Renewable', 'Renewable', 'Renewable',
+    'Renewable', 'Renewable', 'Renewable', 'Renewable', 'Storage']
+YEARS = list(range(2020, 2050, 5))
+
+def make_source(rows, seed=0):
+    '''
+    Return a dataframe of rows rows, with columns scenario, region, technology, type, year, hour and value.
+    Rows are every combination of scenario, region, technology and year for hours 0, 1, 2, ..., truncated to rows.
+    Discrete columns are strings, as read from a csv.
+    '''
+    rng = np.random.RandomState(seed)
+    dims = [len(SCENARIOS), len(REGIONS), len(TECHNOLOGIES), len(YEARS)]
+    n_combos = int(np.prod(dims))
+    idx = np.arange(rows)
+    hour = idx // n_combos
+    rest = idx % n_combos
+    year_i = rest % dims[3]
+    rest = rest // dims[3]
+    tech_i = rest % dims[2]
+    rest = rest // dims[2]
+    region_i = rest % dims[1]
+    scenario_i = rest // dims[1]
+    value = rng.lognormal(mean=3, sigma=1, size=rows) * (1 + 0.1 * scenario_i) * np.where(rng.rand(rows) < 0.05, -1, 1)
+    return pd.DataFrame({
+        'scenario': np.array(SCENARIOS, dtype=object)[scenario_i],
+        'region': np.array(REGIONS, dtype=object)[region_i],
+        'technology': np.array(TECHNOLOGIES, dtype=object)[tech_i],
+        'type': np.array(TECH_TYPES, dtype=object)[tech_i],
+        'year': np.array(YEARS)[year_i],
+        'hour': hour,
+        'value': value.round(3),
+    }, columns=['scenario', 'region', 'technology', 'type', 'year', 'hour', 'value'])
+
+def source_csv(rows, data_dir, seed=0):
+    '''
+    Return the path of a csv of make_source(rows, seed) in data_dir, writing it if it doesn't exist yet.
+    '''
+    path = os.path.join(data_dir, 'synth_%d_%d.csv' % (rows, seed))
+    if not os.path.isfile(path):
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+        tmp_path = path + '.tmp'
+        make_source(rows, seed).to_csv(tmp_path, index=False)
+        os.rename(tmp_path, path)
+    return path
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic data source csv')
+    parser.add_argument('rows', type=int)
+    parser.add_argument('out')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    make_source(args.rows, args.seed).to_csv(args.out, index=False)
@@ -0,0 +1,135 @@
+'''
+Export of the currently viewed data (df_plots) to compact files that the browser downloads from the app's static
+directory, which bokeh serve already serves at <app>/static/. Exports are written off the bokeh server's event loop
+(on pivotpool), to a temporary name that is renamed once the file is complete, so a partial file is never served.
+
+Exported files are kept in static/exports/ for MAX_AGE_HOURS (SUPERPIVOT_EXPORT_HOURS environment variable), and the
+oldest are removed once the folder exceeds QUOTA_MB (SUPERPIVOT_EXPORT_MB), so exports don't fill the server's disk.
+'''
+import os
+import re
+import time
+import datetime
+import tempfile
+import threading
+import zipfile
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+EXPORT_DIR = os.path.join(APP_DIR, 'static', 'exports')
+URL_PATH = os.path.basename(APP_DIR) + '/static/exports/'
+MAX_AGE_HOURS = float(os.environ.get('SUPERPIVOT_EXPORT_HOURS', 24))
+QUOTA_MB = float(os.environ.get('SUPERPIVOT_EXPORT_MB', 1024))
+#parquet and feather require pyarrow
+FORMATS = ['csv.gz', 'parquet', 'feather']
+PART = '.part'
+
+_lock = threading.Lock()
+
+def write_frame(df, path, fmt):
+    '''
+    Write a dataframe to path in one of FORMATS.
+    '''
+    df = df.reset_index(drop=True)
+    if fmt == 'csv.gz':
+        df.to_csv(path, index=False, compression='gzip')
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        df.to_feather(path)
+    else:
+        raise ValueError('Unknown export format: ' + str(fmt))
+
+def export(df, fmt, split_cols=None, name='out'):
+    '''
+    Write df to a new file in EXPORT_DIR, after removing expired exports.
+
+    Args:
+        df (pandas dataframe): Data to export.
+        fmt (string): One of FORMATS.
+        split_cols (list): If not None, write a zip file holding a file for each combination of values of these
+            columns (one per exploded chart) instead.
+        name (string): Start of the file name, which is followed by the current timestamp.
+
+    Returns:
+        filename (string): Name of the file in EXPORT_DIR.
+    '''
+    cleanup()
+    stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S-%f')
+    filename = '%s_%s.%s' % (name, stamp, 'zip' if split_cols is not None else fmt)
+    path = os.path.join(EXPORT_DIR, filename)
+    try:
+        if split_cols is None:
+            write_frame(df, path + PART, fmt)
+        else:
+            #the formats are already compressed, so the files are stored in the zip as they are
+            with zipfile.ZipFile(path + PART, 'w', zipfile.ZIP_STORED) as zf:
+                names = set()
+                for vals, part in df.groupby(split_cols, sort=False, observed=True):
+                    vals = vals if isinstance(vals, tuple) else (vals,)
+                    part_name = unique_name('_'.join(safe_name(v) for v in vals), names)
+                    handle, part_path = tempfile.mkstemp(suffix=PART, dir=EXPORT_DIR)
+                    os.close(handle)
+                    try:
+                        write_frame(part, part_path, fmt)
+                        zf.write(part_path, '%s.%s' % (part_name, fmt))
+                    finally:
+                        os.remove(part_path)
+        os.rename(path + PART, path)
+    except Exception:
+        if os.path.exists(path + PART):
+            os.remove(path + PART)
+        raise
+    return filename
+
+def safe_name(val):
+    '''
+    Return a value as a string that can be used as a file name.
+    '''
+    return re.sub(r'[^\w.-]+', '_', str(val)).strip('.') or '_'
+
+def unique_name(name, names):
+    '''
+    Return name, or if it is already in names (e.g. two values that differ only in characters that safe_name()
+    replaces), name followed by the first free index. The returned name is added to names.
+    '''
+    unique = name
+    i = 1
+    while unique in names:
+        unique = '%s_%d' % (name, i)
+        i += 1
+    names.add(unique)
+    return unique
+
+def file_size(filename):
+    return os.path.getsize(os.path.join(EXPORT_DIR, filename))
+
+def cleanup():
+    '''
+    Remove exports older than MAX_AGE_HOURS, and then the oldest exports until the folder holds at most QUOTA_MB.
+    Files still being written are only removed by age.
+    '''
+    with _lock:
+        now = time.time()
+        files = []
+        for filename in os.listdir(EXPORT_DIR):
+            path = os.path.join(EXPORT_DIR, filename)
+            if filename.startswith('.') or not os.path.isfile(path):
+                continue
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime > MAX_AGE_HOURS * 3600:
+                    os.remove(path)
+                elif not filename.endswith(PART):
+                    files.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                #removed by another process
+                pass
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= QUOTA_MB * 1024 * 1024:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
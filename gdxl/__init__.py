@@ -1,9 +1,107 @@
-import gams
 import os
+import time
+import numpy as np
 import pandas as pd
-import gdxcc
+
+#The GAMS API (gams, gdxcc) is imported by the functions that use it, so that importing this module is cheap and
+#doesn't require GAMS to be installed when no gdx file is read.
+
+#GAMS special value for EPS, which we read as 0.
+EPS_VAL = 5e300
 
 def get_df(file_name, param_name):
+    return get_dfs(file_name, [param_name])[param_name]
+
+def get_dfs(file_name, param_names):
+    '''
+    Read several parameters from one gdx file, opening the file once. Each parameter becomes a dataframe
+    with one categorical column per set dimension (named 0, 1, ...) followed by a float value column.
+    Records are read in bulk into numpy arrays of UEL indices and values, and UEL indices are mapped
+    to labels with a single vectorized lookup.
+
+    Args:
+        file_name (string): Path to gdx file, relative to the working directory.
+        param_names (list): Names of parameters to read.
+
+    Returns:
+        dfs (dict): Keys are parameter names and values are dataframes.
+    '''
+    import gams
+    import gdxcc
+    try:
+        from gams.numpy import Gams2Numpy
+    except ImportError:
+        Gams2Numpy = None
+    ws = gams.GamsWorkspace()
+    gdxFile = os.path.join(os.getcwd(), file_name)
+
+    gdxHandle = gdxcc.new_gdxHandle_tp()
+    rc =  gdxcc.gdxCreate(gdxHandle, gdxcc.GMS_SSSIZE)
+    assert rc[0],rc[1]
+    assert gdxcc.gdxOpenRead(gdxHandle, gdxFile)[0]
+    nrUels = gdxcc.gdxUMUelInfo(gdxHandle)[1]
+    uelMap = np.array([gdxcc.gdxUMUelGet(gdxHandle, i)[1] for i in range(nrUels+1)], dtype=object)
+    g2np = None if Gams2Numpy is None else Gams2Numpy(ws.system_directory)
+
+    dfs = {}
+    for param_name in param_names:
+        ret, symNr = gdxcc.gdxFindSymbol(gdxHandle, param_name)
+        assert ret, param_name + " parameter not found"
+        if g2np is not None:
+            keys, vals = g2np.gdxReadSymbolRaw(gdxHandle, param_name)
+            vals = vals[:, gdxcc.GMS_VAL_LEVEL]
+        else:
+            keys, vals = read_raw(gdxHandle, symNr)
+        dfs[param_name] = build_df(keys, vals, uelMap)
+
+    assert not gdxcc.gdxClose(gdxHandle)
+    assert gdxcc.gdxFree(gdxHandle)
+    return dfs
+
+def read_raw(gdxHandle, symNr):
+    '''
+    Read all records of a symbol into preallocated numpy arrays, for when gams.numpy is not available.
+
+    Returns:
+        keys (numpy array): Integer UEL indices, one row per record and one column per dimension.
+        vals (numpy array): Float level values.
+    '''
+    import gdxcc
+    dim = gdxcc.gdxSymbolInfo(gdxHandle, symNr)[2]
+    ret, nrRecs = gdxcc.gdxDataReadRawStart(gdxHandle, symNr)
+    assert ret, "Error in gdxDataReadRawStart: " + gdxcc.gdxErrorStr(gdxHandle, gdxcc.gdxGetLastError(gdxHandle))[1]
+    keys = np.empty((nrRecs, dim), dtype=np.int32)
+    vals = np.empty(nrRecs, dtype=np.float64)
+    read = gdxcc.gdxDataReadRaw
+    for i in range(nrRecs):
+        ret = read(gdxHandle)
+        keys[i] = ret[1][:dim]
+        vals[i] = ret[2][gdxcc.GMS_VAL_LEVEL]
+    gdxcc.gdxDataReadDone(gdxHandle)
+    return keys, vals
+
+def build_df(keys, vals, uelMap):
+    '''
+    Build a dataframe from UEL index and value arrays. Set columns become categoricals whose codes
+    are the UEL indices, so labels are never materialized per record, and EPS values are replaced with 0.
+    '''
+    data = {}
+    categories = pd.Index(uelMap[1:])
+    for d in range(keys.shape[1]):
+        #UEL numbering starts at 1, so shift to get codes into categories
+        codes = keys[:, d].astype(np.int32) - 1
+        data[d] = pd.Categorical.from_codes(codes, categories=categories).remove_unused_categories()
+    vals = np.array(vals, dtype=np.float64)
+    vals[vals == EPS_VAL] = 0
+    data[keys.shape[1]] = vals
+    return pd.DataFrame(data, columns=list(range(keys.shape[1] + 1)))
+
+def get_df_loop(file_name, param_name):
+    '''
+    Original record-by-record reader, kept as the baseline for bench().
+    '''
+    import gams
+    import gdxcc
     ws = gams.GamsWorkspace()
 
     gdxFile = os.path.join(os.getcwd(), file_name)
@@ -27,7 +125,7 @@ def get_df(file_name, param_name):
         ret = gdxcc.gdxDataReadRaw(gdxHandle)
         sets = [uelMap[x] for x in ret[1]]
         val = ret[2][gdxcc.GMS_VAL_LEVEL]
-        if val == 5e300:
+        if val == EPS_VAL:
             val = 0
         ls.append(sets+[val])
 
@@ -36,7 +134,30 @@ def get_df(file_name, param_name):
     df = pd.DataFrame(ls)
     return df
 
+def bench(file_name, param_name, repeat=3):
+    '''
+    Time get_df() against the original record-by-record reader and check that they agree.
+    '''
+    timings = {}
+    for name, func in [('loop', get_df_loop), ('bulk', get_df)]:
+        best = None
+        for r in range(repeat):
+            start = time.time()
+            df = func(file_name, param_name)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = (best, df)
+    df_loop = timings['loop'][1]
+    df_bulk = timings['bulk'][1].astype({c: object for c in timings['bulk'][1].columns[:-1]})
+    print('records: %d' % len(df_loop))
+    print('loop: %.3fs, bulk: %.3fs, speedup: %.1fx' % (timings['loop'][0], timings['bulk'][0], timings['loop'][0] / max(timings['bulk'][0], 1e-9)))
+    print('results match: %s' % df_loop.equals(df_bulk))
+
 if __name__ == "__main__":
     import sys
-    df = get_df(sys.argv[1], sys.argv[2])
-    print(df)
\ No newline at end of file
+    if '--bench' in sys.argv:
+        sys.argv.remove('--bench')
+        bench(sys.argv[1], sys.argv[2])
+    else:
+        df = get_df(sys.argv[1], sys.argv[2])
+        print(df)
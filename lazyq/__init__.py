@@ -0,0 +1,203 @@
+'''
+Lazy query backend for data sources that are too large to hold in memory, using DuckDB (optional dependency,
+imported on first use).
+A LazySource stands in for df_source: the filter and scale stages of set_df_plots() add to its query, and the
+aggregate stage runs the query and returns only the (usually small) aggregated result as a pandas dataframe,
+which the remaining stages process as usual. DuckDB reads parquet and csv files directly, applying filters and
+reading only the columns used while scanning, so the source is never loaded as a whole.
+
+Parquet files, and csv files prefixed with 'lazy:' in the data source box, use this backend.
+'''
+import os
+import threading
+
+PREFIX = 'lazy:'
+BLANK = '{BLANK}'
+NUMERIC_TYPES = ['TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT',
+    'FLOAT', 'DOUBLE', 'REAL']
+INTEGER_TYPES = NUMERIC_TYPES[:9]
+AGG_SQL = {'Sum': 'SUM(%s)', 'Ave': 'AVG(%s)', 'Min': 'MIN(%s)', 'Max': 'MAX(%s)', 'Median': 'MEDIAN(%s)', 'Count': 'COUNT(%s)'}
+#Aggregations whose result keeps the integer type of the column
+AGG_INTEGER = ['Sum', 'Min', 'Max', 'Count']
+
+def is_lazy(path):
+    '''
+    Return True if a data source path is to be queried lazily. Parquet files are only queried lazily if duckdb
+    is installed, and are otherwise loaded by the parquet reader registered in loaders.
+    '''
+    return path.startswith(PREFIX) or (path.lower().endswith('.parquet') and has_duckdb())
+
+def has_duckdb():
+    '''
+    Return True if duckdb can be imported. It is imported on the first call, rather than with this module.
+    '''
+    try:
+        import duckdb
+    except ImportError:
+        return False
+    return True
+
+def strip_prefix(path):
+    return path[len(PREFIX):] if path.startswith(PREFIX) else path
+
+def quote(name):
+    '''
+    Quote a column name for use in sql.
+    '''
+    return '"' + str(name).replace('"', '""') + '"'
+
+class LazySource(object):
+    '''
+    A query against a parquet or csv file, built up by filter() and scale() and run by collect(). Instances are
+    immutable, so they can be cached and shared like dataframes.
+    '''
+    def __init__(self, path, types, where=(), params=(), scales=None):
+        self.path = path
+        self.types = types
+        self.where = tuple(where)
+        self.params = tuple(params)
+        self.scales = dict(scales or {})
+
+    def relation(self):
+        literal = "'" + self.path.replace("'", "''") + "'"
+        if self.path.lower().endswith('.parquet'):
+            return 'read_parquet(%s)' % literal
+        return 'read_csv_auto(%s)' % literal
+
+    def is_discrete(self, col):
+        return self.types[col] not in NUMERIC_TYPES
+
+    def expr(self, col):
+        '''
+        Return the sql expression of a column, with NA values filled as load_data() does, and scaled.
+        '''
+        if self.is_discrete(col):
+            return "COALESCE(CAST(%s AS VARCHAR), '%s')" % (quote(col), BLANK)
+        expr = 'COALESCE(%s, 0)' % quote(col)
+        if col in self.scales:
+            #DuckDB reads a literal like 0.5 as a DECIMAL, so multiply as doubles to match pandas
+            expr = '(CAST(%s AS DOUBLE) * CAST(%r AS DOUBLE))' % (expr, float(self.scales[col]))
+        return expr
+
+    def filter(self, excluded):
+        '''
+        Return a new LazySource without the rows whose values are in excluded.
+
+        Args:
+            excluded (dict): Keys are columns and values are lists of values to exclude.
+        '''
+        where = list(self.where)
+        params = list(self.params)
+        for col, vals in excluded.items():
+            if len(vals) > 0:
+                where.append('%s NOT IN (%s)' % (self.expr(col), ', '.join(['?'] * len(vals))))
+                params.extend(vals)
+        return LazySource(self.path, self.types, where, params, self.scales)
+
+    def scale(self, scales):
+        '''
+        Return a new LazySource with continuous columns multiplied by scales (a dict of column: factor).
+        Filters added earlier still apply to the unscaled values.
+        '''
+        new = LazySource(self.path, self.types, self.where, self.params, self.scales)
+        for col, factor in scales.items():
+            new.scales[col] = new.scales.get(col, 1) * factor
+        return new
+
+    def collect(self, groupby_cols, y, agg=None, weight=None):
+        '''
+        Run the query and return the result as a dataframe. With an aggregation from AGG_SQL, a percentile
+        (agg is then the quantile, a float) or 'Weighted Ave', there is a row per group of groupby_cols with
+        the aggregated y. Otherwise the groupby_cols and y columns of all rows are returned. Discrete columns
+        are returned as categoricals with sorted categories, as in load_data().
+        '''
+        cols = [c for c in groupby_cols if c != y]
+        select = ['%s AS %s' % (self.expr(c), quote(c)) for c in cols]
+        y_expr = self.expr(y)
+        sql_agg = None
+        if agg in AGG_SQL:
+            sql_agg = AGG_SQL[agg] % y_expr
+            if agg in AGG_INTEGER and self.types[y] in INTEGER_TYPES and y not in self.scales:
+                sql_agg = 'CAST(%s AS BIGINT)' % sql_agg
+        elif isinstance(agg, float):
+            sql_agg = 'QUANTILE_CONT(%s, %r)' % (y_expr, agg)
+        elif agg == 'Weighted Ave' and weight is not None:
+            w_expr = self.expr(weight)
+            sql_agg = 'CASE WHEN SUM(%s) = 0 THEN 0 ELSE SUM(CAST(%s AS DOUBLE) * %s) / SUM(%s) END' % (w_expr, y_expr, w_expr, w_expr)
+        select.append('%s AS %s' % (y_expr if sql_agg is None else sql_agg, quote(y)))
+        sql = 'SELECT %s FROM %s' % (', '.join(select), self.relation())
+        if self.where:
+            sql += ' WHERE ' + ' AND '.join('(%s)' % w for w in self.where)
+        if sql_agg is not None and cols:
+            sql += ' GROUP BY ' + ', '.join(str(i + 1) for i in range(len(cols)))
+            sql += ' ORDER BY ' + ', '.join(str(i + 1) for i in range(len(cols)))
+        df = self.cursor().execute(sql, list(self.params)).df()
+        for col in df.columns:
+            if self.is_discrete(col):
+                ser = df[col].astype('category')
+                df[col] = ser.cat.reorder_categories(sorted(ser.cat.categories.tolist()))
+        return df
+
+    def unique_values(self, col):
+        '''
+        Return the sorted unique values of a column, with NA values filled.
+        '''
+        sql = 'SELECT DISTINCT %s FROM %s' % (self.expr(col), self.relation())
+        return sorted(row[0] for row in self.cursor().execute(sql).fetchall())
+
+    def cursor(self):
+        #DuckDB connections must not be shared between threads, so each thread gets its own cursor, which is
+        #shared by all sources (queries are run one at a time on a thread)
+        cur = getattr(_local, 'cursor', None)
+        if cur is None:
+            cur = _connection().cursor()
+            _local.cursor = cur
+        return cur
+
+_conn = None
+_conn_lock = threading.Lock()
+_local = threading.local()
+
+def _connection():
+    global _conn
+    with _conn_lock:
+        if _conn is None:
+            #imported on first use, so that sessions that don't query lazily don't pay for importing duckdb
+            try:
+                import duckdb
+            except ImportError:
+                raise ImportError('duckdb is required for parquet and lazy: data sources')
+            _conn = duckdb.connect()
+        return _conn
+
+def load_lazy(path):
+    '''
+    Describe a parquet or csv file without loading it, and classify its columns like load_data() does,
+    counting unique values and collecting the values of filterable columns in the database.
+
+    Args:
+        path (string): Path to parquet or csv file, without the lazy: prefix.
+
+    Returns:
+        source (LazySource): Query of the whole file.
+        cols (dict): Column classification, as returned by load_data(), but without a filter index.
+    '''
+    source = LazySource(os.path.realpath(path), {})
+    described = source.cursor().execute('DESCRIBE SELECT * FROM %s' % source.relation()).fetchall()
+    source.types = dict((row[0], row[1].split('(')[0]) for row in described)
+    cols = {}
+    cols['all'] = [row[0] for row in described]
+    cols['discrete'] = [x for x in cols['all'] if source.is_discrete(x)]
+    cols['continuous'] = [x for x in cols['all'] if x not in cols['discrete']]
+    counts = {}
+    if cols['continuous']:
+        #unique values, counting NA as one, like pandas unique()
+        sql = 'SELECT %s FROM %s' % (', '.join('COUNT(DISTINCT %s) + MAX(CASE WHEN %s IS NULL THEN 1 ELSE 0 END)' % (quote(c), quote(c))
+            for c in cols['continuous']), source.relation())
+        counts = dict(zip(cols['continuous'], source.cursor().execute(sql).fetchone()))
+    cols['filterable'] = cols['discrete'] + [x for x in cols['continuous'] if counts[x] < 100]
+    cols['seriesable'] = cols['discrete'] + [x for x in cols['continuous'] if counts[x] < 60]
+    cols['values'] = {}
+    for col in cols['filterable']:
+        cols['values'][col] = source.unique_values(col)
+    return (source, cols)
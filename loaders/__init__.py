@@ -0,0 +1,316 @@
+'''
+Streaming reader for large csv sources. Rather than parsing the whole file with pd.read_csv, which
+holds the text buffers, object columns of strings, and the final frame in memory at once (several times
+the size of the final frame), the file is read in chunks of CHUNK_ROWS rows with dtypes inferred from a
+sample. String columns are read straight into categoricals, and each chunk's columns are moved into
+per-column lists, so peak memory stays close to the size of the final frame.
+
+Files of at least CHUNKED_MIN_BYTES (SUPERPIVOT_CHUNKED_MB environment variable) are read this way.
+
+Sources of several files (a glob pattern, or paths separated by MULTI_SEP, e.g. one file per scenario) are read
+concurrently by a pool of LOAD_WORKERS processes (SUPERPIVOT_LOAD_WORKERS environment variable) with read_files(),
+and combined column by column, with a categorical column of the file each row came from.
+
+Files are read by the reader registered for their extension with register(). Readers import the libraries they need
+(e.g. the GAMS API for gdx files) when first called, so sessions only pay for the formats they actually load.
+'''
+import os
+import re
+import sys
+import site
+import glob
+import logging
+import collections
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+CHUNKED_MIN_BYTES = int(float(os.environ.get('SUPERPIVOT_CHUNKED_MB', 100)) * 1024 * 1024)
+CHUNK_ROWS = 250000
+SAMPLE_ROWS = 10000
+MAX_UNIQUE = 100 #Distinct values of numeric columns are tracked up to this many
+LOAD_WORKERS = int(os.environ.get('SUPERPIVOT_LOAD_WORKERS', multiprocessing.cpu_count()))
+MULTI_SEP = ';'
+FILE_COL = 'file' #Name of the column of file names added to multi-file sources
+
+_logger = logging.getLogger('superpivot')
+
+def use_chunked(path):
+    '''
+    Return True if a csv file is large enough to be read with read_csv_chunked().
+    '''
+    return os.path.getsize(path) >= CHUNKED_MIN_BYTES
+
+def infer_dtypes(path, sample_rows=SAMPLE_ROWS):
+    '''
+    Infer the dtypes to read a csv with from a sample of its first rows. String columns are read as categoricals
+    and float columns as float64. Integer columns are left to be inferred per chunk, because a later chunk
+    may have missing values, and are downcast once the whole file is read. Columns that are empty throughout
+    the sample are also left to be inferred per chunk, as their values may turn out to be strings.
+
+    Returns:
+        dtypes (dict): Keys are column names, and values are dtypes to pass to pd.read_csv.
+    '''
+    sample = pd.read_csv(path, nrows=sample_rows)
+    dtypes = {}
+    for col in sample.columns:
+        if sample[col].dtype == object:
+            dtypes[col] = 'category'
+        elif sample[col].dtype.kind == 'f' and sample[col].notnull().any():
+            dtypes[col] = np.float64
+    return dtypes
+
+def read_csv_chunked(path, progress=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Read a csv file in chunks. Discrete columns become categoricals, with categories unioned across chunks,
+    and integer columns are downcast to the smallest integer type that holds their values. Distinct values
+    of numeric columns are collected while reading, so the column classification and filter values
+    don't need another pass over the data.
+
+    Args:
+        path (string): Path to csv file.
+        progress (function, optional): Called after each chunk with the fraction of the file read so far.
+        chunk_rows (int): Number of rows per chunk.
+
+    Returns:
+        df_source (pandas dataframe): The csv data, with NA values not yet filled.
+        uniques (dict): Keys are numeric columns, and values are lists of their distinct values (including NaN),
+            or None for columns with at least MAX_UNIQUE distinct values.
+    '''
+    dtypes = infer_dtypes(path)
+    size = max(os.path.getsize(path), 1)
+    parts = None
+    uniques = {}
+    with open(path, 'rb') as f:
+        try:
+            for chunk in pd.read_csv(f, dtype=dtypes, chunksize=chunk_rows):
+                if parts is None:
+                    parts = collections.OrderedDict((col, []) for col in chunk.columns)
+                for col in chunk.columns:
+                    ser = chunk[col]
+                    if str(ser.dtype) == 'category':
+                        parts[col].append(ser.values)
+                        continue
+                    if ser.dtype == object:
+                        #a column that was empty in the sample has strings in this chunk
+                        parts[col].append(pd.Categorical(ser.values))
+                        continue
+                    #copy so that the chunk's 2d blocks aren't kept alive by views of their columns
+                    values = np.array(ser.values)
+                    parts[col].append(values)
+                    if values.dtype.kind in 'iuf':
+                        track_uniques(uniques, col, values)
+                del chunk
+                if progress is not None:
+                    progress(min(f.tell() / size, 1.0))
+        except ValueError as e:
+            #a float column of the sample has strings further down, so the sample's dtypes don't hold
+            _logger.warning('Reading %s in one piece, as its dtypes differ from those of its first %d rows: %s',
+                path, SAMPLE_ROWS, e)
+            parts = None
+    if parts is None:
+        return (pd.read_csv(path), {})
+    data = {}
+    for col in list(parts.keys()):
+        data[col] = combine_parts(parts.pop(col))
+        if isinstance(data[col], pd.Categorical):
+            uniques.pop(col, None)
+    df_source = pd.DataFrame(data, columns=list(data.keys()))
+    for col in uniques:
+        if uniques[col] is not None:
+            uniques[col] = [np.nan if v is None else v for v in uniques[col]]
+    return (df_source, uniques)
+
+def combine_parts(parts):
+    '''
+    Concatenate the chunks of one column, emptying the list of chunks as it goes. Categoricals are unioned
+    and integers are downcast to the smallest signed integer type that holds them. Columns with categorical chunks
+    and empty chunks (of a column that was empty in the sample) become categoricals.
+    '''
+    if any(isinstance(p, pd.Categorical) for p in parts):
+        combined = union_categoricals([p if isinstance(p, pd.Categorical) else
+            pd.Categorical(np.asarray(p).astype(object)) for p in parts])
+    else:
+        combined = np.concatenate([np.asarray(p) for p in parts])
+        if combined.dtype.kind == 'i' and len(combined):
+            lo, hi = combined.min(), combined.max()
+            for dtype in [np.int8, np.int16, np.int32]:
+                if np.iinfo(dtype).min <= lo and hi <= np.iinfo(dtype).max:
+                    combined = combined.astype(dtype)
+                    break
+    del parts[:]
+    return combined
+
+def track_uniques(uniques, col, values):
+    '''
+    Add the distinct values of a chunk's numeric column to uniques[col], until there are MAX_UNIQUE of them.
+    NaN is kept at most once.
+    '''
+    if col in uniques and uniques[col] is None:
+        return
+    chunk_vals = pd.unique(values)
+    if len(chunk_vals) >= MAX_UNIQUE:
+        uniques[col] = None
+        return
+    seen = uniques.setdefault(col, set())
+    if values.dtype.kind == 'f' and np.isnan(chunk_vals).any():
+        chunk_vals = chunk_vals[~np.isnan(chunk_vals)]
+        seen.add(None)
+    seen.update(chunk_vals.tolist())
+    if len(seen) >= MAX_UNIQUE:
+        uniques[col] = None
+
+READERS = {}
+
+def register(extension, reader):
+    '''
+    Register the reader of files with an extension. Files with extensions that have no reader are read as csv.
+
+    Args:
+        extension (string): File extension, including the dot, e.g. '.csv'.
+        reader (function): Called as reader(path, param, progress), with the gdx parameter name (or None) and
+            an optional progress function, and returns (df_source, uniques) like read_csv_chunked().
+    '''
+    READERS[extension.lower()] = reader
+
+def read_source(path, param=None, progress=None):
+    '''
+    Read a file with the reader registered for its extension.
+
+    Returns:
+        df_source (pandas dataframe): The file's data, with NA values not yet filled.
+        uniques (dict): Distinct values of numeric columns, as from read_csv_chunked(). May be empty.
+    '''
+    reader = READERS.get(os.path.splitext(path)[1].lower(), read_csv)
+    return reader(path, param, progress)
+
+def read_csv(path, param=None, progress=None):
+    if use_chunked(path):
+        return read_csv_chunked(path, progress)
+    return (pd.read_csv(path), {})
+
+def read_gdx(path, param=None, progress=None):
+    import gdxl
+    df_source = gdxl.get_df(path, param)
+    df_source.columns = df_source.columns.astype(str)
+    return (df_source, {})
+
+def read_parquet(path, param=None, progress=None):
+    #single parquet files are queried lazily (see lazyq), so this is used for the files of multi-file sources
+    return (pd.read_parquet(path), {})
+
+def read_feather(path, param=None, progress=None):
+    return (pd.read_feather(path), {})
+
+register('.csv', read_csv)
+register('.gdx', read_gdx)
+register('.parquet', read_parquet)
+register('.feather', read_feather)
+
+def is_multi(path):
+    '''
+    Return True if a data source path is a glob pattern or a list of paths separated by MULTI_SEP.
+    '''
+    return MULTI_SEP in path or re.search(r'[*?[]', path) is not None
+
+def expand_paths(path):
+    '''
+    Return the list of files of a multi-file data source path. Glob patterns are expanded in sorted order.
+
+    Raises:
+        IOError: If a pattern matches no files.
+    '''
+    paths = []
+    for part in path.split(MULTI_SEP):
+        part = part.strip()
+        if part == '':
+            continue
+        matches = sorted(glob.glob(part)) if re.search(r'[*?[]', part) else [part]
+        if not matches:
+            raise IOError('No files match ' + part)
+        paths.extend(matches)
+    return paths
+
+def file_labels(paths):
+    '''
+    Return the label of each file in the file column: its name without extension, or if that isn't unique,
+    its path without extension.
+    '''
+    names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+    if len(set(names)) < len(names):
+        names = [os.path.splitext(p)[0] for p in paths]
+    return names
+
+def read_file(path, param=None):
+    '''
+    Read one file of a multi-file source, in a worker process. String columns are returned as categoricals,
+    which are much smaller to send back to the parent process than columns of strings.
+
+    Args:
+        path (string): Path to csv or gdx file.
+        param (string, optional): Name of gdx parameter to read. Only used for gdx files.
+
+    Returns:
+        columns (ordered dict): Keys are column names and values are arrays (numpy arrays or categoricals).
+    '''
+    df = read_source(path, param)[0]
+    columns = collections.OrderedDict()
+    for col in df.columns:
+        ser = df[col]
+        columns[col] = ser.astype('category').values if ser.dtype == object else ser.values
+    return columns
+
+def read_files(paths, param=None, progress=None):
+    '''
+    Read the files of a multi-file source concurrently in a pool of processes (or one after another if LOAD_WORKERS
+    is 1), and combine them into one dataframe with combine_parts(), so each column is concatenated once.
+    A categorical column (FILE_COL, with underscores appended if the files already have such a column) holds
+    the label of the file each row came from. Files must have the same columns.
+
+    Args:
+        paths (list): Paths to csv or gdx files, from expand_paths().
+        param (string, optional): Name of gdx parameter to read from gdx files.
+        progress (function, optional): Called with the fraction of files read so far.
+
+    Returns:
+        df_source (pandas dataframe): The combined data, with NA values not yet filled.
+    '''
+    results = [None] * len(paths)
+    if len(paths) == 1 or LOAD_WORKERS <= 1:
+        for i, path in enumerate(paths):
+            results[i] = read_file(path, param)
+            if progress is not None:
+                progress((i + 1) / len(paths))
+    else:
+        kwargs = {'max_workers': max(1, min(LOAD_WORKERS, len(paths)))}
+        #the bokeh server has running threads, which aren't safe to fork, so workers are started fresh. They need
+        #the app directory on their path to import this module, which bokeh serve only adds while running main.py.
+        if sys.version_info >= (3, 7):
+            kwargs['mp_context'] = multiprocessing.get_context('spawn')
+            kwargs['initializer'] = site.addsitedir
+            kwargs['initargs'] = (os.path.dirname(os.path.dirname(os.path.realpath(__file__))),)
+        with concurrent.futures.ProcessPoolExecutor(**kwargs) as executor:
+            futures = dict((executor.submit(read_file, path, param), i) for i, path in enumerate(paths))
+            for n_done, future in enumerate(concurrent.futures.as_completed(futures)):
+                results[futures[future]] = future.result()
+                if progress is not None:
+                    progress((n_done + 1) / len(paths))
+    columns = list(results[0].keys())
+    for path, result in zip(paths, results):
+        if list(result.keys()) != columns:
+            raise ValueError('Columns of %s (%s) differ from those of %s (%s)' % (path, ', '.join(result.keys()),
+                paths[0], ', '.join(columns)))
+    labels = file_labels(paths)
+    categories = sorted(set(labels))
+    lengths = [len(result[columns[0]]) if columns else 0 for result in results]
+    codes = np.repeat(np.array([categories.index(l) for l in labels], dtype=np.min_scalar_type(len(categories))), lengths)
+    file_col = FILE_COL
+    while file_col in columns:
+        file_col += '_'
+    data = collections.OrderedDict()
+    data[file_col] = pd.Categorical.from_codes(codes, categories=categories)
+    for col in columns:
+        data[col] = combine_parts([result.pop(col) for result in results])
+    return pd.DataFrame(data, columns=list(data.keys()))
@@ -7,17 +7,29 @@ from __future__ import division
 import os
 import math
 import json
+import numpy as np
 import pandas as pd
 import collections
+import threading
+from functools import partial
 import bokeh.io as bio
 import bokeh.layouts as bl
 import bokeh.models.widgets as bmw
 import bokeh.models.sources as bms
 import bokeh.models.tools as bmt
+import bokeh.models.glyphs as bmg
 import bokeh.plotting as bp
-import datetime
+import time
+import logging
 import six.moves.urllib.parse as urlp
-import gdxl
+import srccache
+import loaders
+import lazyq
+import pivotpool
+import pivotprof
+import rollup
+import exports
+from bokeh.util.serialization import transform_column_source_data
 
 #Defaults to configure:
 PLOT_WIDTH = 300
@@ -31,12 +43,24 @@ Y_SCALE = 1
 CIRCLE_SIZE = 9
 BAR_WIDTH = 0.5
 LINE_WIDTH = 2
+LOD_POINTS = 20000 #Dot and Line charts with more points than this per chart are decimated. 0 turns this off.
+STAGE_CACHE_MB = float(os.environ.get('SUPERPIVOT_STAGE_CACHE_MB', 64)) #Memory budget of the set_df_plots stage results kept per session
+PLOT_DEBOUNCE_MS = 150 #Plots are rebuilt once widgets have stopped changing for this long
+FILTER_PAGE_SIZE = 50 #Number of values shown at once in the filter editor
 COLORS = ['#5e4fa2', '#3288bd', '#66c2a5', '#abdda4', '#e6f598', '#fee08b', '#fdae61', '#f46d43', '#d53e4f', '#9e0142']*1000
 C_NORM = "#31AADE"
 CHARTTYPES = ['Dot', 'Line', 'Bar', 'Area']
 STACKEDTYPES = ['Bar', 'Area']
-AGGREGATIONS = ['None', 'Sum', 'Ave', 'Weighted Ave']
+AGGREGATIONS = ['None', 'Sum', 'Ave', 'Weighted Ave', 'Min', 'Max', 'Median', 'Count',
+    '10th Percentile', '25th Percentile', '75th Percentile', '90th Percentile']
+AGG_FUNCS = {'Sum': 'sum', 'Ave': 'mean', 'Min': 'min', 'Max': 'max', 'Median': 'median', 'Count': 'count'}
+AGG_QUANTILES = {'10th Percentile': 0.1, '25th Percentile': 0.25, '75th Percentile': 0.75, '90th Percentile': 0.9}
+ADV_OPS = ['None', 'Difference', 'Ratio', 'Percent Change', 'Share of Total', 'Cumulative Sum']
+ADV_OPS_NO_BASE = ['Share of Total', 'Cumulative Sum']
 ADV_BASES = ['Consecutive', 'Total']
+RENDER_MODES = ['Per Series', 'Batched'] #Batched draws all series of a figure with one glyph renderer
+OUTPUT_BACKENDS = ['canvas', 'webgl'] #webgl is only used for Dot and Line charts
+EXPORT_SPLITS = ['One File', 'File Per Chart'] #File Per Chart exports a zip file with the rows of each exploded chart
 
 #List of widgets that use columns as their selectors
 WDG_COL_ALL = ['x', 'y'] #all columns available for these widgets
@@ -44,20 +68,48 @@ WDG_COL_SER = ['x_group', 'series', 'explode', 'explode_group'] #seriesable colu
 WDG_COL = WDG_COL_ALL + WDG_COL_SER
 
 #List of widgets that don't use columns as selector and share general widget update function
-WDG_NON_COL = ['chart_type', 'y_agg', 'y_weight', 'adv_op', 'adv_col_base', 'plot_title', 'plot_title_size',
-    'plot_width', 'plot_height', 'opacity', 'x_min', 'x_max', 'x_scale', 'x_title',
+WDG_NON_COL = ['chart_type', 'y_agg', 'y_weight', 'adv_op', 'adv_col_base', 'x_scale', 'y_scale', 'lod_points', 'render_mode',
+    'output_backend']
+
+#List of widgets that change what the x and y axes measure, so figures are rebuilt (and their ranges reset) when they change
+AXIS_WIDGETS = ['x', 'y', 'x_scale', 'y_scale', 'y_agg', 'y_weight', 'adv_op', 'adv_col', 'adv_col_base']
+
+#List of widgets that only change the appearance of figures, so figures are restyled in place when they change
+WDG_STYLE = ['plot_title', 'plot_title_size', 'plot_width', 'plot_height', 'opacity', 'x_min', 'x_max', 'x_title',
     'x_title_size', 'x_major_label_size', 'x_major_label_orientation',
-    'y_min', 'y_max', 'y_scale', 'y_title', 'y_title_size', 'y_major_label_size',
+    'y_min', 'y_max', 'y_title', 'y_title_size', 'y_major_label_size',
     'circle_size', 'bar_width', 'line_width']
 
+#Stages of set_df_plots, in order, with the widgets that each stage depends on. 'filters' stands for all filter widgets.
+PIVOT_STAGES = [
+    ('filter', ['filters']),
+    ('scale', ['x', 'y', 'x_scale', 'y_scale']),
+    ('aggregate', ['x', 'y', 'x_group', 'series', 'explode', 'explode_group', 'y_agg', 'y_weight']),
+    ('compare', ['y', 'y_agg', 'adv_op', 'adv_col', 'adv_col_base']),
+    ('sort', ['x', 'y', 'x_group', 'series', 'explode', 'explode_group']),
+]
+
+#Copy of a widget's state, from snapshot_widgets()
+WidgetState = collections.namedtuple('WidgetState', ['value', 'text'])
+
+#bokeh serve leaves the root logger at WARNING, so show this app's info messages (session startup times and,
+#when profiling, pivotprof's profiles) unless logging has been configured otherwise
+_logger = logging.getLogger('superpivot')
+if _logger.level == logging.NOTSET:
+    _logger.setLevel(logging.INFO)
+
 #initialize globals dict for variables that are modified within update functions.
-GL = {'df_source':None, 'df_plots':None, 'columns':None, 'top_wdg':None, 'widgets':None, 'controls': None, 'plots':None}
+GL = {'df_source':None, 'df_plots':None, 'columns':None, 'top_wdg':None, 'widgets':None, 'controls': None, 'plots':None, 'stage_cache':None, 'layout':None, 'doc':None, 'load_id':0,
+    'plot_gen':0, 'plot_timeout':None, 'plot_lock':threading.Lock(), 'specs':None, 'lod_timeouts':{}, 'filter_open':None,
+    'export_id':0}
 
 def initialize():
     '''
     On initial load, read 'widgets' parameter from URL query string and use to set data source (data_source)
-    and widget configuration object (wdg_config)
+    and widget configuration object (wdg_config). Only the data source box is built here, so a new session's page
+    is sent as soon as possible, and the time this takes is logged on the 'superpivot' logger.
     '''
+    start = time.time()
     wdg_config = {}
     args = bio.curdoc().session_context.request.arguments
     wdg_arr = args.get('widgets')
@@ -67,58 +119,219 @@ def initialize():
         if 'data' in wdg_config:
             data_source = str(wdg_config['data'])
 
-    #build widgets and plots
+    #build widgets and plots. The data source is loaded in the background, and the rest of the widgets
+    #and the plots are added once it is loaded.
+    GL['doc'] = bio.curdoc()
     GL['top_wdg'] = build_top_wdg(data_source)
     GL['widgets'] = GL['top_wdg'].copy()
     GL['plots'] = bl.column([], id='plots_section')
-    if data_source != '':
-        GL['df_source'], GL['columns'] = get_data(data_source)
-        GL['widgets'].update(build_widgets(GL['df_source'], GL['columns'], init_load=True, init_config=wdg_config))
-        set_wdg_col_options()
-        update_plots()
     GL['controls'] = bl.widgetbox(list(GL['widgets'].values()), id='widgets_section')
     layout = bl.row(GL['controls'], GL['plots'], id='layout')
 
-    bio.curdoc().add_root(layout)
-    bio.curdoc().title = "Exploding Pivot Chart Maker"
+    GL['doc'].add_root(layout)
+    GL['doc'].title = "Exploding Pivot Chart Maker"
+    if data_source != '':
+        load_source(data_source, init_load=True, init_config=wdg_config)
+    _logger.info('Session started in %.1f ms', (time.time() - start) * 1000)
 
 def build_top_wdg(data_source):
     wdg = collections.OrderedDict()
     wdg['data'] = bmw.TextInput(title='Data Source (required)', value=data_source, css_classes=['wdgkey-data'])
     wdg['data'].on_change('value', update_data)
+    wdg['load_progress'] = bmw.Div(text='', css_classes=['load-progress'])
     return wdg
 
-def get_data(data_source):
+def load_source(data_source, init_load=False, init_config={}):
+    '''
+    Load a data source with get_data() in a background thread, so that the session stays responsive
+    during long loads, and show loading progress in the load_progress widget. Once loaded, the rest of
+    the widgets are built (and the plots, on initial load) by finish_load() on the document's thread.
+    If the data source changes while loading, the result of the earlier load is ignored.
+
+    Args:
+        data_source (string): Path to csv file, or path to gdx file and parameter name separated by '>'.
+        init_load (boolean, optional): If this is the initial page load.
+        init_config (dict, optional): Initial widget configuration passed from url.
+    '''
+    doc = GL['doc']
+    GL['load_id'] += 1
+    load_id = GL['load_id']
+    GL['top_wdg']['load_progress'].text = 'Loading data...'
+    def progress(fraction):
+        doc.add_next_tick_callback(partial(set_load_status, load_id, 'Loading data: %d%%' % (fraction * 100)))
+    def load():
+        profile = pivotprof.new_profile('load', data_source=data_source)
+        try:
+            df_source, cols = pivotprof.stage(profile, 'get_data', get_data, data_source, progress)
+        except Exception as e:
+            doc.add_next_tick_callback(partial(set_load_status, load_id, 'Error loading data: ' + str(e)))
+            raise
+        doc.add_next_tick_callback(partial(finish_load, load_id, df_source, cols, init_load, init_config, profile))
+    thread = threading.Thread(target=load)
+    thread.daemon = True
+    thread.start()
+
+def set_load_status(load_id, text):
+    '''
+    Set the text of the load_progress widget, unless a newer load has started.
+    '''
+    if load_id == GL['load_id']:
+        GL['top_wdg']['load_progress'].text = text
+
+def finish_load(load_id, df_source, cols, init_load=False, init_config={}, profile=None):
+    '''
+    Once a data source is loaded by load_source(), build its widgets, and on initial load also the plots.
+    '''
+    if load_id != GL['load_id']:
+        return
+    GL['top_wdg']['load_progress'].text = ''
+    GL['df_source'], GL['columns'] = df_source, cols
+    GL['stage_cache'] = new_stage_cache()
+    GL['filter_open'] = None
+    GL['widgets'].update(pivotprof.stage(profile, 'build_widgets', build_widgets, df_source, cols, init_load, init_config))
+    if 'diagnostics' in GL['widgets']:
+        GL['widgets']['diagnostics'].text = pivotprof.finish(profile)
+    if init_load:
+        set_wdg_col_options()
+        update_plots()
+    GL['controls'].children = list(GL['widgets'].values())
+
+def get_data(data_source, progress=None):
+    '''
+    Return the dataframe and column classification for a data source. Sources are loaded with load_data()
+    and held in the process-wide srccache, so sessions viewing the same unchanged file share one copy.
+    The returned dataframe is shared and read-only, so it must be copied before modification.
+
+    Args:
+        data_source (string): Path to csv file, or path to gdx file and parameter name separated by '>'.
+            Parquet files, and csv files prefixed with 'lazy:', are queried lazily with lazyq. A glob pattern or
+            list of paths separated by ';' (optionally followed by '>' and a parameter name for gdx files)
+            is read as one source with a column of file names, see loaders.read_files().
+        progress (function, optional): Passed to load_data() to report loading progress.
+
+    Returns:
+        df_source (pandas dataframe): A dataframe of the csv source, with filled NA values, or a lazyq.LazySource.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+    '''
+    data_source = data_source.replace('"', '')
+    if lazyq.is_lazy(data_source) and not loaders.is_multi(data_source):
+        path = lazyq.strip_prefix(data_source)
+        return srccache.get(srccache.make_key(path, lazyq.PREFIX), lazyq.load_lazy, path)
+    path_parts = data_source.split('>')
+    if loaders.is_multi(path_parts[0]):
+        param = str(path_parts[1]) if len(path_parts) > 1 else None
+        key = srccache.make_multi_key(path_parts[0], loaders.expand_paths(path_parts[0]), param)
+        return srccache.get(key, load_data, str(path_parts[0]), param, progress)
+    param = str(path_parts[1]) if path_parts[0].lower().endswith('.gdx') else None
+    key = srccache.make_key(path_parts[0], param)
+    return srccache.get(key, load_data, str(path_parts[0]), param, progress)
+
+def load_data(path, param=None, progress=None):
     '''
     Read a csv into a pandas dataframe, and determine which columns of the dataframe
     are discrete (strings), continuous (numbers), able to be filtered (aka filterable),
     and able to be used as a series (aka seriesable). NA values are filled based on the type of column,
-    and the dataframe and columns are returned.
+    and the dataframe and columns are returned. Files are read by the reader that loaders has registered for their
+    extension (large csv files are read in chunks), and multi-file sources are read concurrently with loaders.read_files().
 
     Args:
-        data_source (string): Path to csv file.
+        path (string): Path to csv or gdx file, or a glob pattern or list of paths separated by ';'.
+        param (string, optional): Name of gdx parameter to read. Only used for gdx files.
+        progress (function, optional): Called with the fraction of the file (or files) read so far, for chunked
+            and multi-file reads.
 
     Returns:
         df_source (pandas dataframe): A dataframe of the csv source, with filled NA values.
         cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+            Additionally, cols['values'] maps each filterable column to its sorted unique values, and
+            cols['filter_index'] is the filter index from build_filter_index().
     '''
-    data_source = data_source.replace('"', '')
-    path_parts = data_source.split('>')
-    if path_parts[0].lower().endswith('.gdx'):
-        df_source = gdxl.get_df(str(path_parts[0]), str(path_parts[1]))
-        df_source.columns = df_source.columns.astype(str)
+    multi = loaders.is_multi(path)
+    if srccache.SIDECAR and not multi:
+        cached = srccache.read_sidecar(path, param)
+        if cached is not None:
+            df_source, cols = cached
+            cols['filter_index'] = build_filter_index(df_source, cols)
+            return (df_source, cols)
+    uniques = {}
+    if multi:
+        df_source = loaders.read_files(loaders.expand_paths(path), param, progress)
     else:
-        df_source = pd.read_csv(data_source)
+        df_source, uniques = loaders.read_source(path, param, progress)
     cols = {}
     cols['all'] = df_source.columns.values.tolist()
-    cols['discrete'] = [x for x in cols['all'] if df_source[x].dtype == object]
+    cols['discrete'] = [x for x in cols['all'] if df_source[x].dtype == object or str(df_source[x].dtype) == 'category']
     cols['continuous'] = [x for x in cols['all'] if x not in cols['discrete']]
-    cols['filterable'] = cols['discrete']+[x for x in cols['continuous'] if len(df_source[x].unique()) < 100]
-    cols['seriesable'] = cols['discrete']+[x for x in cols['continuous'] if len(df_source[x].unique()) < 60]
-    df_source[cols['discrete']] = df_source[cols['discrete']].fillna('{BLANK}')
+    #number of unique values of continuous columns, from the chunked reader where available
+    n_unique = {}
+    for x in cols['continuous']:
+        if x in uniques:
+            n_unique[x] = loaders.MAX_UNIQUE if uniques[x] is None else len(uniques[x])
+        else:
+            n_unique[x] = len(df_source[x].unique())
+    cols['filterable'] = cols['discrete']+[x for x in cols['continuous'] if n_unique[x] < 100]
+    cols['seriesable'] = cols['discrete']+[x for x in cols['continuous'] if n_unique[x] < 60]
+    for col in cols['discrete']:
+        df_source[col] = sorted_categorical(df_source[col])
     df_source[cols['continuous']] = df_source[cols['continuous']].fillna(0)
+    cols['values'] = {}
+    for col in cols['filterable']:
+        if col in cols['discrete']:
+            cols['values'][col] = df_source[col].cat.categories.tolist()
+        elif uniques.get(col) is not None:
+            cols['values'][col] = sorted(set(0 if pd.isnull(v) else v for v in uniques[col]))
+        else:
+            cols['values'][col] = sorted(df_source[col].unique().tolist())
+    if srccache.SIDECAR and not multi:
+        srccache.write_sidecar(path, param, df_source, cols)
+    cols['filter_index'] = build_filter_index(df_source, cols)
     return (df_source, cols)
 
+def build_filter_index(df_source, cols):
+    '''
+    For each filterable column, find the position of every row's value in cols['values'][col], which
+    is also the index of that value's checkbox in the column's filter widget. Any filter state can then
+    be applied by looking up the codes in a boolean array of kept values, without comparing any labels.
+
+    Args:
+        df_source (pandas dataframe): A dataframe of the csv source, with filled NA values.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+
+    Returns:
+        filter_index (dict): Keys are filterable columns, and values are numpy arrays of codes, one per row.
+    '''
+    filter_index = {}
+    for col in cols['filterable']:
+        values = cols['values'][col]
+        if str(df_source[col].dtype) == 'category':
+            codes = df_source[col].cat.codes.values
+            categories = df_source[col].cat.categories
+            if categories.tolist() != values:
+                codes = pd.Index(values).get_indexer(categories)[codes]
+        else:
+            codes = np.searchsorted(np.array(values), df_source[col].values)
+        filter_index[col] = codes.astype(np.min_scalar_type(len(values)), copy=False)
+    return filter_index
+
+def sorted_categorical(ser):
+    '''
+    Convert a discrete column to a categorical with sorted categories, filling NA values with '{BLANK}'.
+    Filters, groupby, and sorting then operate on the integer codes rather than on strings,
+    and sorting by the column gives the same order as sorting its labels.
+
+    Args:
+        ser (pandas series): Column of strings, or a categorical.
+
+    Returns:
+        ser (pandas series): Categorical column.
+    '''
+    if str(ser.dtype) != 'category':
+        ser = ser.astype('category')
+    if ser.isnull().any():
+        ser = ser.cat.add_categories(['{BLANK}']).fillna('{BLANK}')
+    ser = ser.cat.remove_unused_categories()
+    return ser.cat.reorder_categories(sorted(ser.cat.categories.tolist()))
+
 def build_widgets(df_source, cols, init_load=False, init_config={}):
     '''
     Use a dataframe and its columns to set widget options. Widget values may
@@ -151,14 +364,21 @@ def build_widgets(df_source, cols, init_load=False, init_config={}):
     wdg['explode_group'] = bmw.Select(title='Group Exploded Charts By', value='None', options=['None'] + cols['seriesable'],
         css_classes=['wdgkey-explode_group', 'explode-drop'])
     wdg['adv_dropdown'] = bmw.Div(text='Comparisons', css_classes=['adv-dropdown'])
-    wdg['adv_op'] = bmw.Select(title='Operation', value='None', options=['None', 'Difference', 'Ratio'], css_classes=['wdgkey-adv_op', 'adv-drop'])
+    wdg['adv_op'] = bmw.Select(title='Operation', value='None', options=ADV_OPS, css_classes=['wdgkey-adv_op', 'adv-drop'])
     wdg['adv_col'] = bmw.Select(title='Operate Across', value='None', options=['None'] + cols['all'], css_classes=['wdgkey-adv_col', 'adv-drop'])
     wdg['adv_col_base'] = bmw.Select(title='Base', value='None', options=['None'], css_classes=['wdgkey-adv_col_base', 'adv-drop'])
     wdg['filters'] = bmw.Div(text='Filters', css_classes=['filters-dropdown'])
     for j, col in enumerate(cols['filterable']):
-        val_list = [str(i) for i in sorted(df_source[col].unique().tolist())]
-        wdg['heading_filter_'+str(j)] = bmw.Div(text=col, css_classes=['filter-head'])
-        wdg['filter_'+str(j)] = bmw.CheckboxGroup(labels=val_list, active=list(range(len(val_list))), css_classes=['wdgkey-filter_'+str(j), 'filter'])
+        wdg['heading_filter_'+str(j)] = bmw.Button(label=col, css_classes=['filter-head'])
+    #A single editor shows a page of values of the filter whose heading was last clicked, so the document
+    #doesn't grow with the number of filter values. Filter state is kept in filter_state (see filter_excluded()).
+    wdg['filter_title'] = bmw.Div(text='', css_classes=['filter-editor', 'filter-title'])
+    wdg['filter_search'] = bmw.TextInput(title='Search', value='', css_classes=['filter-editor', 'filter-search'])
+    wdg['filter_values'] = bmw.CheckboxGroup(labels=[], active=[], css_classes=['filter-editor'])
+    filter_btns = [bmw.Button(label=label, width=48) for label in ['All', 'None', '<', '>']]
+    wdg['filter_buttons'] = bl.row(filter_btns, css_classes=['filter-editor'])
+    wdg['filter_page'] = bmw.Div(text='', css_classes=['filter-editor'])
+    wdg['filter_state'] = bmw.Div(text='{}', css_classes=['filter-state'])
     wdg['update'] = bmw.Button(label='Update Filters', button_type='success', css_classes=['filters-update'])
     wdg['adjustments'] = bmw.Div(text='Plot Adjustments', css_classes=['adjust-dropdown'])
     wdg['chart_type'] = bmw.Select(title='Chart Type', value='Dot', options=CHARTTYPES, css_classes=['wdgkey-chart_type', 'adjust-drop'])
@@ -184,19 +404,35 @@ def build_widgets(df_source, cols, init_load=False, init_config={}):
     wdg['circle_size'] = bmw.TextInput(title='Circle Size (Dot Only)', value=str(CIRCLE_SIZE), css_classes=['wdgkey-circle_size', 'adjust-drop'])
     wdg['bar_width'] = bmw.TextInput(title='Bar Width (Bar Only)', value=str(BAR_WIDTH), css_classes=['wdgkey-bar_width', 'adjust-drop'])
     wdg['line_width'] = bmw.TextInput(title='Line Width (Line Only)', value=str(LINE_WIDTH), css_classes=['wdgkey-line_width', 'adjust-drop'])
-    wdg['download'] = bmw.Button(label='Download csv', button_type='success')
+    wdg['lod_points'] = bmw.TextInput(title='Max Points Per Chart (Dot/Line, 0 for All)', value=str(LOD_POINTS), css_classes=['wdgkey-lod_points', 'adjust-drop'])
+    wdg['render_mode'] = bmw.Select(title='Series Glyphs', value='Per Series', options=RENDER_MODES, css_classes=['wdgkey-render_mode', 'adjust-drop'])
+    wdg['output_backend'] = bmw.Select(title='Output Backend (Dot/Line Only)', value='canvas', options=OUTPUT_BACKENDS,
+        css_classes=['wdgkey-output_backend', 'adjust-drop'])
+    wdg['export_format'] = bmw.Select(title='Export Format', value=exports.FORMATS[0], options=exports.FORMATS, css_classes=['wdgkey-export_format'])
+    wdg['export_split'] = bmw.Select(title='Export Exploded Charts As', value=EXPORT_SPLITS[0], options=EXPORT_SPLITS, css_classes=['wdgkey-export_split'])
+    wdg['download'] = bmw.Button(label='Export Data', button_type='success')
+    wdg['export_status'] = bmw.Div(text='', css_classes=['export-status'])
     wdg['export_config'] = bmw.Div(text='Export Config to URL', css_classes=['export-config', 'bk-bs-btn', 'bk-bs-btn-success'])
+    if pivotprof.ENABLED:
+        wdg['diagnostics_dropdown'] = bmw.Div(text='Diagnostics', css_classes=['diagnostics-dropdown'])
+        wdg['diagnostics'] = bmw.Div(text='', css_classes=['diagnostics-drop'])
 
     #use init_config (from 'widgets' parameter in URL query string) to configure widgets.
     if init_load:
         for key in init_config:
-            if key in wdg:
-                if hasattr(wdg[key], 'value'):
-                    wdg[key].value = str(init_config[key])
-                elif hasattr(wdg[key], 'active'):
-                    wdg[key].active = init_config[key]
+            if key in wdg and hasattr(wdg[key], 'value'):
+                wdg[key].value = str(init_config[key])
+        set_filter_excluded(wdg, cols, config_excluded(init_config, cols))
 
     #Add update functions for widgets
+    for j in range(len(cols['filterable'])):
+        wdg['heading_filter_'+str(j)].on_click(partial(open_filter, j))
+    wdg['filter_search'].on_change('value', update_filter_search)
+    wdg['filter_values'].on_change('active', update_filter_values)
+    filter_btns[0].on_click(partial(select_filter_values, True))
+    filter_btns[1].on_click(partial(select_filter_values, False))
+    filter_btns[2].on_click(partial(page_filter, -1))
+    filter_btns[3].on_click(partial(page_filter, 1))
     wdg['update'].on_click(update_plots)
     wdg['download'].on_click(download)
     wdg['adv_col'].on_change('value', update_adv_col)
@@ -204,99 +440,385 @@ def build_widgets(df_source, cols, init_load=False, init_config={}):
         wdg[name].on_change('value', update_wdg_col)
     for name in WDG_NON_COL:
         wdg[name].on_change('value', update_wdg)
+    for name in WDG_STYLE:
+        wdg[name].on_change('value', partial(update_wdg_style, name))
 
     return wdg
 
-def set_df_plots(df_source, cols, wdg):
+def filter_excluded(wdg, cols):
+    '''
+    Return the filter state, which is held by the filter_state widget as json of the excluded codes of each filter,
+    keyed by the filter's position in cols['filterable'].
+
+    Returns:
+        excluded (dict): Keys are filterable columns with excluded values, and values are lists of excluded codes
+            (positions in cols['values'][col]).
     '''
-    Apply filters, scaling, aggregation, and sorting to source dataframe, and return the result.
+    state = json.loads(wdg['filter_state'].text)
+    return dict((cols['filterable'][int(j)], codes) for j, codes in state.items())
+
+def set_filter_excluded(wdg, cols, excluded):
+    '''
+    Set the filter state to excluded (keys are filterable columns, and values are iterables of excluded codes),
+    and show the number of excluded values in the filter headings. The state is written as canonical json, so
+    that equal states have equal text.
+    '''
+    state = {}
+    for j, col in enumerate(cols['filterable']):
+        codes = sorted(set(int(c) for c in excluded.get(col, []) if 0 <= int(c) < len(cols['values'][col])))
+        if codes:
+            state[str(j)] = codes
+        wdg['heading_filter_'+str(j)].label = '%s (%d excluded)' % (col, len(codes)) if codes else col
+    wdg['filter_state'].text = json.dumps(state, sort_keys=True, separators=(',', ':'))
+
+def config_excluded(init_config, cols):
+    '''
+    Return the excluded codes of each filter in a widget configuration from the URL. Exported configurations have
+    filter_state, and older ones have the active (checked) codes of each filter as filter_0, filter_1, etc.
+    '''
+    state = init_config.get('filter_state', {})
+    excluded = {}
+    for j, col in enumerate(cols['filterable']):
+        if str(j) in state:
+            excluded[col] = state[str(j)]
+        elif 'filter_'+str(j) in init_config:
+            active = set(int(i) for i in init_config['filter_'+str(j)])
+            excluded[col] = [i for i in range(len(cols['values'][col])) if i not in active]
+    return excluded
+
+def set_df_plots(df_source, cols, wdg, cache=None, cancelled=None, profile=None):
+    '''
+    Apply filters, scaling, aggregation, comparisons, and sorting to source dataframe, and return the result.
+    Each of these is a stage in PIVOT_STAGES. If a stage cache is given, the result of each stage is stored under
+    the values of the widgets that it and the stages before it depend on, so that stages whose inputs have not changed
+    are not rerun. For example, changing the y axis scale reuses the filtered data, and changing cosmetic
+    widgets like plot_title reruns nothing. Sum, Ave and Count pivots of large sources skip the filter, scale and
+    aggregate stages, and are answered from the source's rollup cube instead (see rollup).
 
     Args:
         df_source (pandas dataframe): Dataframe of the csv source.
         cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
         wdg (ordered dict): Dictionary of bokeh model widgets.
+        cache (dict, optional): Stage cache from new_stage_cache(). After the call, cache['recomputed']
+            lists the names of the stages that were run rather than taken from the cache.
+        cancelled (function, optional): Checked before each stage. If it returns True, no more stages are run.
+        profile (dict, optional): Profile from pivotprof.new_profile(), to record each stage in.
 
     Returns:
-        df_plots (pandas dataframe): df_source after having been filtered, scaled, aggregated, and sorted.
+        df_plots (pandas dataframe): df_source after having been filtered, scaled, aggregated, and sorted,
+            or None if cancelled.
     '''
-    df_plots = df_source.copy()
+    #Stages must not modify their input, which may be df_source (shared between sessions) or a cached result.
+    stage_funcs = {'filter': filter_df, 'scale': scale_df, 'aggregate': aggregate_df, 'compare': compare_df, 'sort': sort_df}
+    keys = []
+    key = (id(df_source),)
+    for name, deps in PIVOT_STAGES:
+        key = key + ((name, stage_key(wdg, cols, deps)),)
+        keys.append(key)
 
-    #Apply filters
-    for j, col in enumerate(cols['filterable']):
-        active = [wdg['filter_'+str(j)].labels[i] for i in wdg['filter_'+str(j)].active]
-        if col in cols['continuous']:
-            active = [float(i) for i in active]
-        df_plots = df_plots[df_plots[col].isin(active)]
-
-    #Scale Axes
-    if wdg['x_scale'].value != '' and wdg['x'].value in cols['continuous']:
-        df_plots[wdg['x'].value] = df_plots[wdg['x'].value] * float(wdg['x_scale'].value)
-    if wdg['y_scale'].value != '' and wdg['y'].value in cols['continuous']:
-        df_plots[wdg['y'].value] = df_plots[wdg['y'].value] * float(wdg['y_scale'].value)
-
-    #Apply Aggregation
+    #Start after the last stage whose result is cached
+    df_plots = df_source
+    start = 0
+    if cache is not None:
+        cache['recomputed'] = []
+        for i in reversed(range(len(keys))):
+            if keys[i] in cache['entries']:
+                df_plots = cache['entries'].pop(keys[i])[0]
+                cache['entries'][keys[i]] = (df_plots, frame_bytes(df_plots, df_source))
+                start = i + 1
+                break
+    for name, deps in PIVOT_STAGES[:start]:
+        last = name == PIVOT_STAGES[start - 1][0] and isinstance(df_plots, pd.DataFrame)
+        pivotprof.record(profile, name, 0, rows_out=len(df_plots) if last else None, cached=True)
+
+    #Sum, Ave and Count pivots of large sources are answered from the source's rollup cube, in place of the
+    #filter, scale and aggregate stages.
+    agg_i = [name for name, deps in PIVOT_STAGES].index('aggregate')
+    if start <= agg_i and use_rollup(df_source, cols, wdg):
+        df_rolled = pivotprof.stage(profile, 'rollup', rollup_df, df_source, cols, wdg)
+        if df_rolled is not None:
+            df_plots = df_rolled
+            start = agg_i + 1
+            if cache is not None:
+                cache['recomputed'].append('rollup')
+                cache_stage(cache, keys[agg_i], df_plots, df_source)
+    for i in range(start, len(PIVOT_STAGES)):
+        if cancelled is not None and cancelled():
+            return None
+        name = PIVOT_STAGES[i][0]
+        df_plots = pivotprof.stage(profile, name, stage_funcs[name], df_plots, cols, wdg)
+        if cache is not None:
+            cache['recomputed'].append(name)
+            cache_stage(cache, keys[i], df_plots, df_source)
+    return df_plots
+
+def cache_stage(cache, key, df_plots, df_source):
+    '''
+    Store a stage result in the stage cache, and drop the least recently used results while the cache holds more
+    than STAGE_CACHE_MB. The result just stored is kept even if it alone exceeds the budget. Results that are
+    df_source itself, or lazy queries, take no memory of their own.
+    '''
+    cache['entries'][key] = (df_plots, frame_bytes(df_plots, df_source))
+    while len(cache['entries']) > 1 and sum(v[1] for v in cache['entries'].values()) > STAGE_CACHE_MB * 1024 * 1024:
+        cache['entries'].popitem(last=False)
+
+def frame_bytes(df_plots, df_source):
+    '''
+    Return the memory used by a stage result, not counting df_source, which is shared with other sessions.
+    '''
+    if df_plots is df_source or not isinstance(df_plots, pd.DataFrame):
+        return 0
+    return int(df_plots.memory_usage(index=True, deep=False).sum())
+
+def use_rollup(df_source, cols, wdg):
+    '''
+    Return True if the pivot for the widget values may be answered from the source's rollup cube.
+    '''
+    return rollup.can_use(df_source, cols, groupby_columns(wdg), wdg['y'].value, wdg['y_agg'].value, scale_factors(cols, wdg))
+
+def rollup_df(df_source, cols, wdg):
+    '''
+    Filter, scale and aggregate the source by rolling up its rollup cube, which is built on first use.
+    Returns None if the source has no cube worth keeping.
+    '''
+    cube = rollup.get_cube(df_source, cols)
+    if cube is None:
+        return None
+    return rollup.query(cube, cols, groupby_columns(wdg), wdg['y'].value, wdg['y_agg'].value, filter_excluded(wdg, cols),
+        scale_factors(cols, wdg))
+
+def new_stage_cache():
+    '''
+    Return an empty stage cache for set_df_plots(). The cache holds (stage result, bytes) tuples in least recently used order.
+    '''
+    return {'entries': collections.OrderedDict(), 'recomputed': []}
+
+def stage_key(wdg, cols, deps):
+    '''
+    Return a hashable tuple of the values of the widgets in deps. 'filters' stands for the filter state,
+    whose text is canonical json (see set_filter_excluded()).
+    '''
+    vals = []
+    for name in deps:
+        if name == 'filters':
+            vals.append(wdg['filter_state'].text)
+        else:
+            vals.append(wdg[name].value)
+    return tuple(vals)
+
+def filter_df(df_plots, cols, wdg):
+    '''
+    Filter stage of set_df_plots(). Combine the masks of all filters, using the filter index, and select rows once.
+    The input is not copied when nothing is filtered. Lazy sources get the filters added to their query.
+    '''
+    excluded = filter_excluded(wdg, cols)
+    if isinstance(df_plots, lazyq.LazySource):
+        dropped = dict((col, [cols['values'][col][i] for i in codes]) for col, codes in excluded.items())
+        return df_plots.filter(dropped) if dropped else df_plots
+    mask = None
+    for col, codes in excluded.items():
+        keep = np.ones(len(cols['values'][col]), dtype=bool)
+        keep[codes] = False
+        col_mask = keep[cols['filter_index'][col]]
+        mask = col_mask if mask is None else mask & col_mask
+    return df_plots if mask is None else df_plots[mask]
+
+def scale_df(df_plots, cols, wdg):
+    '''
+    Scale stage of set_df_plots(). Multiply continuous x and y columns by their scale widgets.
+    '''
+    scales = scale_factors(cols, wdg)
+    if scales and isinstance(df_plots, lazyq.LazySource):
+        return df_plots.scale(scales)
+    if scales:
+        #shallow copy, so that the unscaled columns are shared rather than copied
+        df_plots = df_plots.copy(deep=False)
+        for col in scales:
+            df_plots[col] = df_plots[col] * scales[col]
+    return df_plots
+
+def scale_factors(cols, wdg):
+    '''
+    Return a dict of the continuous columns (x and y) to be scaled, and the factors to multiply them by.
+    Columns with a factor of 1 are left out, so they aren't copied.
+    '''
+    scales = {}
+    if wdg['x_scale'].value != '' and wdg['x'].value in cols['continuous'] and float(wdg['x_scale'].value) != 1:
+        scales[wdg['x'].value] = float(wdg['x_scale'].value)
+    if wdg['y_scale'].value != '' and wdg['y'].value in cols['continuous'] and float(wdg['y_scale'].value) != 1:
+        scales[wdg['y'].value] = float(wdg['y_scale'].value)
+    return scales
+
+def aggregate_df(df_plots, cols, wdg):
+    '''
+    Aggregation stage of set_df_plots(). Group by x and the series, explode, and grouping columns, and aggregate y.
+    The query of a lazy source is run here, so the result is always a dataframe.
+    '''
+    groupby_cols = groupby_columns(wdg)
+    if isinstance(df_plots, lazyq.LazySource):
+        return aggregate_lazy(df_plots, groupby_cols, wdg, cols)
     if wdg['y'].value in cols['continuous'] and wdg['y_agg'].value != 'None':
-        groupby_cols = [wdg['x'].value]
-        if wdg['x_group'].value != 'None': groupby_cols = [wdg['x_group'].value] + groupby_cols
-        if wdg['series'].value != 'None': groupby_cols = [wdg['series'].value] + groupby_cols
-        if wdg['explode'].value != 'None': groupby_cols = [wdg['explode'].value] + groupby_cols
-        if wdg['explode_group'].value != 'None': groupby_cols = [wdg['explode_group'].value] + groupby_cols
-        df_grouped = df_plots.groupby(groupby_cols, sort=False)
-        if wdg['y_agg'].value == 'Sum':
-            df_plots = df_grouped[wdg['y'].value].sum().reset_index()
-        elif wdg['y_agg'].value == 'Ave':
-            df_plots = df_grouped[wdg['y'].value].mean().reset_index()
-        elif wdg['y_agg'].value == 'Weighted Ave' and wdg['y_weight'].value in cols['continuous']:
-            df_plots = df_grouped.apply(wavg, wdg['y'].value, wdg['y_weight'].value).reset_index()
-            df_plots.rename(columns={0: wdg['y'].value}, inplace=True)
-
-    #Do Advanced Operations
+        df_plots = aggregate_y(df_plots, groupby_cols, wdg['y'].value, wdg['y_agg'].value, wdg['y_weight'].value, cols)
+    return df_plots
+
+def groupby_columns(wdg):
+    '''
+    Return the columns that y is aggregated by: the explode group, explode, series, x group and x columns that are set.
+    '''
+    groupby_cols = [wdg['x'].value]
+    if wdg['x_group'].value != 'None': groupby_cols = [wdg['x_group'].value] + groupby_cols
+    if wdg['series'].value != 'None': groupby_cols = [wdg['series'].value] + groupby_cols
+    if wdg['explode'].value != 'None': groupby_cols = [wdg['explode'].value] + groupby_cols
+    if wdg['explode_group'].value != 'None': groupby_cols = [wdg['explode_group'].value] + groupby_cols
+    return groupby_cols
+
+def aggregate_lazy(source, groupby_cols, wdg, cols):
+    '''
+    Run the query of a lazy source, aggregating y like aggregate_y() does. Without aggregation, all columns of
+    the rows that pass the filters are read, as they are for sources in memory.
+
+    Args:
+        source (lazyq.LazySource): Filtered and scaled source.
+        groupby_cols (list): Columns to group by.
+        wdg (ordered dict): Dictionary of bokeh model widgets.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+
+    Returns:
+        df_plots (pandas dataframe): Result of the query.
+    '''
+    y = wdg['y'].value
+    agg = wdg['y_agg'].value
+    weight = wdg['y_weight'].value
+    if y not in cols['continuous'] or agg == 'None' or (agg == 'Weighted Ave' and weight not in cols['continuous']):
+        agg = None
+        groupby_cols = cols['all']
+    elif agg in AGG_QUANTILES:
+        agg = AGG_QUANTILES[agg]
+    return source.collect(groupby_cols, y, agg, weight)
+
+def aggregate_y(df_plots, groupby_cols, y, agg, weight, cols):
+    '''
+    Aggregate a y column by groups, using only built-in vectorized groupby aggregations. Weighted averages
+    are the groups' sums of y times weight divided by their sums of weight, and are 0 for groups whose weights sum to 0.
+
+    Args:
+        df_plots (pandas dataframe): Dataframe to aggregate.
+        groupby_cols (list): Columns to group by.
+        y (string): Column to aggregate.
+        agg (string): Aggregation, from AGGREGATIONS.
+        weight (string): Weighting factor column, for 'Weighted Ave'.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+
+    Returns:
+        df_plots (pandas dataframe): One row per group, with groupby_cols and the aggregated y column.
+            df_plots is returned unchanged if agg can't be applied.
+    '''
+    df_grouped = df_plots.groupby(groupby_cols, sort=False, observed=True)
+    if agg in AGG_FUNCS:
+        return df_grouped[y].agg(AGG_FUNCS[agg]).reset_index()
+    elif agg in AGG_QUANTILES:
+        return df_grouped[y].quantile(AGG_QUANTILES[agg]).reset_index()
+    elif agg == 'Weighted Ave' and weight in cols['continuous']:
+        #in float, so that products of downcast integer columns don't overflow
+        df_weighted = pd.DataFrame({'yw': df_plots[y].astype(np.float64) * df_plots[weight], 'w': df_plots[weight]})
+        df_sums = df_weighted.groupby([df_plots[c] for c in groupby_cols], sort=False, observed=True).sum()
+        w_sums = df_sums['w'].values
+        ser = pd.Series(np.where(w_sums == 0, 0, df_sums['yw'].values / np.where(w_sums == 0, 1, w_sums)), index=df_sums.index, name=y)
+        return ser.reset_index()
+    return df_plots
+
+def compare_df(df_plots, cols, wdg):
+    '''
+    Comparison stage of set_df_plots(). Compare y values across the values of the adv_col column, within groups
+    of rows that match on all other columns. Differences, ratios and percent changes are relative to the base value
+    of adv_col (adv_col_base), to the previous value of adv_col (Consecutive), or to the group's sum (Total).
+    Share of Total and Cumulative Sum don't use a base. Rows are aligned with their base using integer group ids
+    and numpy indexing, in the order in which adv_col values first appear.
+    '''
     op = wdg['adv_op'].value
     col = wdg['adv_col'].value
     col_base = wdg['adv_col_base'].value
     y_val = wdg['y'].value
     y_agg = wdg['y_agg'].value
-    if op != 'None' and col != 'None' and col in df_plots and col_base != 'None' and y_agg != 'None' and y_val in cols['continuous']:
-        #sort df_plots so that col_base is at the front, so that we can use transform('first') later
-        if col in cols['continuous'] and col_base not in ADV_BASES:
-            col_base = float(col_base)
-        col_list = df_plots[col].unique().tolist()
-        if col_base not in ADV_BASES:
-            col_list.remove(col_base)
-            col_list = [col_base] + col_list
-        df_plots['tempsort'] = df_plots[col].map(lambda x: col_list.index(x))
-        df_plots = df_plots.sort_values('tempsort').reset_index(drop=True)
-        df_plots.drop(['tempsort'], axis='columns', inplace=True)
-        #groupby all columns that are not the operating column and y axis column so we can do operations on y-axis across the operating column
-        groupcols = [i for i in df_plots.columns.values.tolist() if i not in [col, y_val]]
-        if groupcols != []:
-            df_grouped = df_plots.groupby(groupcols, sort=False)[y_val]
+    if op == 'None' or col == 'None' or col not in df_plots or y_agg == 'None' or y_val not in cols['continuous']:
+        return df_plots
+    if col_base == 'None' and op not in ADV_OPS_NO_BASE:
+        return df_plots
+    if col in cols['continuous'] and col_base not in ADV_BASES + ['None']:
+        col_base = float(col_base)
+
+    #Order of adv_col values, with a value base first. Other values are in order of first appearance.
+    order, col_vals = pd.factorize(df_plots[col])
+    is_base = np.zeros(len(df_plots), dtype=bool)
+    if op not in ADV_OPS_NO_BASE and col_base not in ADV_BASES:
+        base_codes = np.flatnonzero(col_vals == col_base)
+        if len(base_codes):
+            is_base = order == base_codes[0]
+            order = np.where(is_base, -1, order)
+
+    #Integer id of each row's group of all columns that are not the operating column or y axis column
+    groupcols = [i for i in df_plots.columns.values.tolist() if i not in [col, y_val]]
+    if groupcols != []:
+        gid = df_plots.groupby(groupcols, sort=False, observed=True).ngroup().values
+    else:
+        gid = np.zeros(len(df_plots), dtype=np.int64)
+    n_groups = gid.max() + 1 if len(gid) else 0
+    y = df_plots[y_val].values.astype(np.float64)
+
+    #Now do operations with the groups:
+    if (col_base == 'Consecutive' and op not in ADV_OPS_NO_BASE) or op == 'Cumulative Sum':
+        #sort by group and then adv_col order, compute along the sorted rows, and put the results back in place
+        perm = np.lexsort((order, gid))
+        y_s = y[perm]
+        starts = np.ones(len(y_s), dtype=bool)
+        starts[1:] = gid[perm][1:] != gid[perm][:-1]
+        if op == 'Cumulative Sum':
+            cums = y_s.cumsum()
+            offsets = (cums - y_s)[starts][np.cumsum(starts) - 1]
+            result_s = cums - offsets
         else:
-            #if we don't have other columns to group, make one, to prevent error
-            df_plots['tempgroup'] = 1
-            df_grouped = df_plots.groupby('tempgroup', sort=False)[y_val]
-        #Now do operations with the groups:
+            prev = np.append(np.nan, y_s[:-1])
+            prev[starts] = np.nan
+            result_s = compare_values(op, y_s, prev)
+        result = np.empty(len(y))
+        result[perm] = result_s
+    elif op == 'Share of Total' or col_base == 'Total':
+        totals = np.bincount(gid, weights=y, minlength=n_groups)[gid]
+        result = compare_values(op, y, totals)
+    else:
+        bases = np.full(n_groups, np.nan)
+        bases[gid[is_base]] = y[is_base]
+        result = compare_values(op, y, bases[gid])
+
+    #Finally, keep rows in adv_col order, dropping rows with the base value and any rows with NAs for y_vals
+    keep = ~is_base & ~np.isnan(result)
+    rows = np.argsort(order, kind='mergesort')
+    rows = rows[keep[rows]]
+    df_plots = df_plots.iloc[rows].reset_index(drop=True)
+    result = result[rows]
+    int_result = (op == 'Difference' and col_base != 'Consecutive') or op == 'Cumulative Sum'
+    if int_result and df_plots[y_val].dtype.kind in 'iu':
+        #int64 rather than y's own dtype, which may be a downcast type too small for differences and sums
+        result = result.astype(np.int64)
+    df_plots[y_val] = result
+    return df_plots
+
+def compare_values(op, y, bases):
+    '''
+    Compare y values to their bases (or group totals, for Share of Total).
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
         if op == 'Difference':
-            if col_base == 'Consecutive':
-                df_plots[y_val] = df_grouped.diff()
-            elif col_base == 'Total':
-                df_plots[y_val] = df_plots[y_val] - df_grouped.transform('sum')
-            else:
-                df_plots[y_val] = df_plots[y_val] - df_grouped.transform('first')
-        elif op == 'Ratio':
-            if col_base == 'Consecutive':
-                df_plots[y_val] = df_grouped.diff()
-            elif col_base == 'Total':
-                df_plots[y_val] = df_plots[y_val] / df_grouped.transform('sum')
-            else:
-                df_plots[y_val] = df_plots[y_val] / df_grouped.transform('first')
-        #Finally, clean up df_plots, dropping unnecessary columns, rows with the base value, and any rows with NAs for y_vals
-        if 'tempgroup' in df_plots:
-            df_plots.drop(['tempgroup'], axis='columns', inplace=True)
-        df_plots = df_plots[~df_plots[col].isin([col_base])]
-        df_plots = df_plots[pd.notnull(df_plots[y_val])]
-
-    #Sort Dataframe
+            return y - bases
+        elif op in ['Ratio', 'Share of Total']:
+            return y / bases
+        elif op == 'Percent Change':
+            return (y - bases) / bases * 100
+
+def sort_df(df_plots, cols, wdg):
+    '''
+    Sort stage of set_df_plots(). Sort by the explode, series, and x columns, and put them first for csv download.
+    '''
     sortby_cols = [wdg['x'].value]
     if wdg['x_group'].value != 'None': sortby_cols = [wdg['x_group'].value] + sortby_cols
     if wdg['series'].value != 'None': sortby_cols = [wdg['series'].value] + sortby_cols
@@ -307,7 +829,6 @@ def set_df_plots(df_source, cols, wdg):
     #Rearrange column order for csv download
     unsorted_columns = [col for col in df_plots.columns if col not in sortby_cols + [wdg['y'].value]]
     df_plots = df_plots[sortby_cols + unsorted_columns + [wdg['y'].value]]
-
     return df_plots
 
 def create_figures(df_plots, wdg, cols):
@@ -323,45 +844,123 @@ def create_figures(df_plots, wdg, cols):
     Returns:
         plot_list (list): List of bokeh.model.figures.
     '''
-    plot_list = []
+    return [create_figure(spec, wdg, cols) for spec in figure_specs(df_plots, wdg, cols)]
+
+def figure_specs(df_plots, wdg, cols):
+    '''
+    Split a dataframe into the data of each figure, using the explode widgets, without creating any bokeh models.
+
+    Args:
+        df_plots (pandas dataframe): Dataframe of csv source after being filtered, scaled, aggregated, and sorted.
+        wdg (ordered dict): Dictionary of bokeh model widgets.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+
+    Returns:
+        specs (list): List of figure specs from figure_data(), one per figure.
+    '''
+    specs = []
     df_plots_cp = df_plots.copy()
+    # If x_group has a value, create a combined column in the dataframe for x and x_group
+    if wdg['x_group'].value != 'None':
+        df_plots_cp[get_x_col(wdg)] = df_plots_cp[wdg['x_group'].value].astype(str) + ' ' + df_plots_cp[wdg['x'].value].astype(str)
+    colors = {}
+    stacks = None
+    if wdg['series'].value != 'None':
+        #Colors are set from series values across all figures, so a series has the same color in each figure
+        colors = dict((ser, COLORS[i]) for i, ser in enumerate(df_plots[wdg['series'].value].unique().tolist()))
+    if wdg['series'].value != 'None' and wdg['chart_type'].value in STACKEDTYPES:
+        stacks = stack_series(df_plots_cp, wdg)
     if wdg['explode'].value == 'None':
-        plot_list.append(create_figure(df_plots_cp, df_plots, wdg, cols))
+        specs.append(figure_data(df_plots_cp, colors, wdg, cols, stacks=stacks))
+    elif wdg['explode_group'].value == 'None':
+        for (explode_val,), df_exploded in split_sorted(df_plots_cp, [wdg['explode'].value]):
+            specs.append(figure_data(df_exploded, colors, wdg, cols, explode_val, stacks=stacks))
     else:
-        if wdg['explode_group'].value == 'None':
-            for explode_val in df_plots_cp[wdg['explode'].value].unique().tolist():
-                df_exploded = df_plots_cp[df_plots_cp[wdg['explode'].value].isin([explode_val])]
-                plot_list.append(create_figure(df_exploded, df_plots, wdg, cols, explode_val))
-        else:
-            for explode_group in df_plots_cp[wdg['explode_group'].value].unique().tolist():
-                df_exploded_group = df_plots_cp[df_plots_cp[wdg['explode_group'].value].isin([explode_group])]
-                for explode_val in df_exploded_group[wdg['explode'].value].unique().tolist():
-                    df_exploded = df_exploded_group[df_exploded_group[wdg['explode'].value].isin([explode_val])]
-                    plot_list.append(create_figure(df_exploded, df_plots, wdg, cols, explode_val, explode_group))
-    return plot_list
+        for (explode_group, explode_val), df_exploded in split_sorted(df_plots_cp, [wdg['explode_group'].value, wdg['explode'].value]):
+            specs.append(figure_data(df_exploded, colors, wdg, cols, explode_val, explode_group, stacks=stacks))
+    return specs
+
+def split_sorted(df, by):
+    '''
+    Split a dataframe into consecutive runs of rows with the same values in the columns of by, in a single pass.
+    set_df_plots() sorts by the explode and series columns, so each run holds all rows of one figure or series,
+    and runs are in the same order as the unique values of the columns.
+
+    Args:
+        df (pandas dataframe): Dataframe sorted by the columns in by.
+        by (list): Column names.
+
+    Returns:
+        splits (list): List of (key, df_split) tuples, where key is a tuple of the values of the by columns
+            and df_split is a slice of df.
+    '''
+    if len(df) == 0:
+        return []
+    change = np.zeros(len(df), dtype=bool)
+    change[0] = True
+    for col in by:
+        codes = pd.factorize(df[col])[0]
+        change[1:] |= codes[1:] != codes[:-1]
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], len(df))
+    keys = list(zip(*[df[col].iloc[starts].tolist() for col in by]))
+    return [(keys[i], df.iloc[starts[i]:ends[i]]) for i in range(len(starts))]
+
+def get_x_col(wdg):
+    '''
+    Return the name of the column used for x values, which is a combined column when x is grouped.
+    '''
+    if wdg['x_group'].value != 'None':
+        return str(wdg['x_group'].value) + '_' + str(wdg['x'].value)
+    return wdg['x'].value
 
-def create_figure(df_exploded, df_plots, wdg, cols, explode_val=None, explode_group=None):
+def stack_series(df_plots, wdg):
     '''
-    Create and return a figure based on the data in a dataframe and widget configuration.
+    Compute the stacking of series for all figures at once. The y values are pivoted into a table with a row
+    for each explode value and x value and a column for each series, and positive and negative values
+    are cumulatively summed across the series separately.
+
+    Args:
+        df_plots (pandas dataframe): Dataframe of all plots data, including the combined x column if x is grouped.
+        wdg (ordered dict): Dictionary of bokeh model widgets.
+
+    Returns:
+        stacks (dict): Dataframes indexed by the explode columns and x, with a column per series.
+            'pos' and 'neg' are the tops of each series' positive and negative stacks, and 'pos_base' and 'neg_base' the bottoms.
+    '''
+    ser_col = wdg['series'].value
+    keys = [c for c in [wdg['explode_group'].value, wdg['explode'].value] if c != 'None'] + [get_x_col(wdg)]
+    #Like the series loop before it, use the first y value when there are several for an x value
+    df_pivot = df_plots.groupby(keys + [ser_col], observed=True)[wdg['y'].value].first().unstack(ser_col, fill_value=0)
+    vals = df_pivot.values
+    stacks = {}
+    for part, part_vals in [('pos', np.where(vals > 0, vals, 0)), ('neg', np.where(vals < 0, vals, 0))]:
+        tops = part_vals.cumsum(axis=1)
+        stacks[part] = pd.DataFrame(tops, index=df_pivot.index, columns=df_pivot.columns)
+        stacks[part + '_base'] = pd.DataFrame(tops - part_vals, index=df_pivot.index, columns=df_pivot.columns)
+    return stacks
+
+def figure_data(df_exploded, colors, wdg, cols, explode_val=None, explode_group=None, stacks=None):
+    '''
+    Compute the ranges and glyph data of a figure based on the data in a dataframe and widget configuration.
 
     Args:
         df_exploded (pandas dataframe): Dataframe of just the data that will be plotted in this figure.
-        df_plots (pandas dataframe): Dataframe of all plots data, used only for maintaining consistent series colors.
+        colors (dict): Keys are series values and values are colors, shared by all figures.
         wdg (ordered dict): Dictionary of bokeh model widgets.
         cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
         explode_val (string, optional): The value in the column designated by wdg['explode'] that applies to this figure.
         explode_group (string, optional): The value in the wdg['explode_group'] column that applies to this figure.
+        stacks (dict, optional): Stacked series of all figures from stack_series(), when series are stacked.
 
     Returns:
-        p (bokeh.model.figure): A figure, with all glyphs added by the add_glyph() function.
+        spec (dict): 'explode_val' and 'explode_group' of the figure, 'kw' with keyword arguments for the figure's ranges,
+            and 'glyphs', a list of dicts with the 'series', 'color', and ColumnDataSource 'data' of each glyph.
+            Decimated glyphs (see lod_data()) also have their 'full' data.
     '''
-    # If x_group has a value, create a combined column in the dataframe for x and x_group
-    x_col = wdg['x'].value
-    if wdg['x_group'].value != 'None':
-        x_col = str(wdg['x_group'].value) + '_' + str(wdg['x'].value)
-        df_exploded[x_col] = df_exploded[wdg['x_group'].value].map(str) + ' ' + df_exploded[wdg['x'].value].map(str)
+    x_col = get_x_col(wdg)
 
-    #Build x and y ranges and figure title
+    #Build x and y ranges
     kw = dict()
 
     #Set x and y ranges. When x is grouped, there is added complication of separating the groups
@@ -382,28 +981,136 @@ def create_figure(df_exploded, df_plots, wdg, cols, explode_val=None, explode_gr
     if wdg['y'].value in cols['discrete']:
         kw['y_range'] = sorted(set(ys))
 
-    #Set figure title
-    kw['title'] = wdg['plot_title'].value
-    seperator = '' if kw['title'] == '' else ', '
-    if explode_val is not None:
-        if explode_group is not None:
-            kw['title'] = kw['title'] + seperator + "%s = %s" % (wdg['explode_group'].value, str(explode_group))
-        seperator = '' if kw['title'] == '' else ', '
-        kw['title'] = kw['title'] + seperator + "%s = %s" % (wdg['explode'].value, str(explode_val))
-
-    #Add figure tools
-    hover = bmt.HoverTool(
-            tooltips=[
-                ("ser", "@ser_legend"),
-                ("x", "@x_legend"),
-                ("y", "@y_legend"),
-            ]
-    )
+    #Build glyph data
+    glyphs = []
+    c = C_NORM
+    if wdg['series'].value == 'None':
+        if wdg['y_agg'].value != 'None' and wdg['y'].value in cols['continuous']:
+            xs = df_exploded[x_col].values.tolist()
+            ys = df_exploded[wdg['y'].value].values.tolist()
+        glyphs.append({'series': None, 'color': c, 'data': glyph_data(wdg, xs, ys)})
+    else:
+        if stacks is not None: #We are stacking the series, so slice this figure's rows from the stacks
+            fig_key = tuple(v for v in [explode_group, explode_val] if v is not None)
+            fig_stacks = dict((k, v.loc[fig_key] if fig_key else v) for k, v in stacks.items())
+            xs_full = fig_stacks['pos'].index.tolist()
+        for (ser,), df_series in split_sorted(df_exploded, [wdg['series'].value]):
+            c = colors[ser]
+            if stacks is None: #The series will not be stacked
+                xs_ser = df_series[x_col].values.tolist()
+                ys_ser = df_series[wdg['y'].value].values.tolist()
+                glyphs.append({'series': ser, 'color': c, 'data': glyph_data(wdg, xs_ser, ys_ser, series=ser)})
+            else: #We are stacking the series
+                for part in ['pos', 'neg']:
+                    ys_stacked = fig_stacks[part][ser].values
+                    y_bases = fig_stacks[part + '_base'][ser].values
+                    glyphs.append({'series': ser, 'color': c, 'data': glyph_data(wdg, xs_full, ys_stacked, y_bases=y_bases, series=ser)})
+    glyphs = [g for g in glyphs if g['data'] is not None]
+
+    #Decimate dense Dot and Line charts, keeping the full resolution data of the glyphs to refine on zoom
+    budget = lod_budget(wdg, cols)
+    if budget and sum(len(g['data']['x']) for g in glyphs) > budget:
+        n_buckets = lod_buckets(wdg, budget, len(glyphs))
+        for g in glyphs:
+            g['full'] = g['data']
+            g['data'] = lod_data(g['full'], n_buckets)
+    if wdg['render_mode'].value == 'Batched' and glyphs:
+        glyphs = [{'series': None, 'color': None, 'parts': glyphs,
+            'data': merge_glyph_data([g['data'] for g in glyphs], [g['color'] for g in glyphs], [g['series'] for g in glyphs],
+                wdg['chart_type'].value)}]
+    return {'explode_val': explode_val, 'explode_group': explode_group, 'kw': kw, 'glyphs': glyphs}
+
+def merge_glyph_data(datas, colors, series, chart_type):
+    '''
+    Merge the data of the glyphs of a figure into the data of a single glyph, with a color column, so that all series
+    are drawn by one renderer: Dot and Bar points are concatenated, and the lines of Line charts and the patches of
+    Area charts become the items of a multi_line or patches glyph, with the series of each item in ser_legend.
+
+    Args:
+        datas (list): Glyph data from glyph_data(), one per series (or per stacked part of a series).
+        colors (list): Color of each glyph.
+        series (list): Series of each glyph (None without series).
+        chart_type (string): Chart type, from CHARTTYPES.
+
+    Returns:
+        data (dict): Keys are column names and values are numpy arrays, or for Line and Area, lists with an item per glyph.
+    '''
+    if chart_type in ['Dot', 'Bar']:
+        data = dict((k, np.concatenate([d[k] for d in datas])) for k in datas[0])
+        data['color'] = np.repeat(np.array(colors, dtype=object), [len(d['x']) for d in datas])
+        return data
+    return {'xs': [d['x'] for d in datas], 'ys': [d['y'] for d in datas], 'color': list(colors),
+        'ser_legend': ['None' if ser is None else ser for ser in series]}
+
+def glyph_points(data):
+    '''
+    Return the number of points in the data of a glyph, merged or not.
+    '''
+    return len(data['x']) if 'x' in data else sum(len(xs) for xs in data['xs'])
+
+def create_figure(spec, wdg, cols):
+    '''
+    Create and return a figure from a figure spec and widget configuration.
+
+    Args:
+        spec (dict): Figure spec from figure_data().
+        wdg (ordered dict): Dictionary of bokeh model widgets.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+
+    Returns:
+        p (bokeh.model.figure): A figure, with all glyphs added by the add_glyph() function.
+    '''
+    #Add figure tools. The items of merged Line and Area glyphs only have a series.
+    if wdg['render_mode'].value == 'Batched' and wdg['chart_type'].value in ['Line', 'Area']:
+        tooltips = [("ser", "@ser_legend")]
+    else:
+        tooltips = [("ser", "@ser_legend"), ("x", "@x_legend"), ("y", "@y_legend")]
+    hover = bmt.HoverTool(tooltips=tooltips)
     TOOLS = [bmt.BoxZoomTool(), bmt.PanTool(), hover, bmt.ResetTool(), bmt.SaveTool()]
 
-    #Create figure with the ranges, titles, and tools, and adjust formatting and labels
-    p = bp.figure(plot_height=int(wdg['plot_height'].value), plot_width=int(wdg['plot_width'].value), tools=TOOLS, **kw)
+    #Create figure with the ranges and tools. The explode values are kept in tags for restyling.
+    backend = wdg['output_backend'].value if wdg['chart_type'].value in ['Dot', 'Line'] else 'canvas'
+    p = bp.figure(tools=TOOLS, tags=[spec['explode_val'], spec['explode_group']], output_backend=backend, **spec['kw'])
     p.toolbar.active_drag = TOOLS[0]
+    if GL['doc'] is not None and wdg['x'].value in cols['continuous'] and wdg['x_group'].value == 'None':
+        #when zoomed or panned, refine the decimated glyphs for the visible x range
+        p.x_range.on_change('start', partial(update_lod, p))
+        p.x_range.on_change('end', partial(update_lod, p))
+
+    #Add glyphs to figure
+    for glyph in spec['glyphs']:
+        add_glyph(wdg, p, glyph)
+    style_figure(p, wdg, cols, spec['explode_val'], spec['explode_group'])
+    return p
+
+def style_figure(p, wdg, cols, explode_val=None, explode_group=None, changed=None):
+    '''
+    Set the title, size, axis formatting, axis limits, and glyph appearance of a figure from the widgets in WDG_STYLE.
+    This is used both for new figures and to restyle existing figures in place, in which case only properties
+    whose values change are sent to the browser. When restyling, axis limits are only set if their own widgets
+    changed, so that other changes keep the figure's pan and zoom.
+
+    Args:
+        p (bokeh.model.figure): Bokeh figure.
+        wdg (ordered dict): Dictionary of bokeh model widgets.
+        cols (dict): Keys are categories of columns of df_source, and values are a list of columns of that category.
+        explode_val (string, optional): The value in the column designated by wdg['explode'] that applies to this figure.
+        explode_group (string, optional): The value in the wdg['explode_group'] column that applies to this figure.
+        changed (string, optional): Name of the WDG_STYLE widget that changed, when restyling in place.
+
+    Returns:
+        Nothing.
+    '''
+    title = wdg['plot_title'].value
+    seperator = '' if title == '' else ', '
+    if explode_val is not None:
+        if explode_group is not None:
+            title = title + seperator + "%s = %s" % (wdg['explode_group'].value, str(explode_group))
+        seperator = '' if title == '' else ', '
+        title = title + seperator + "%s = %s" % (wdg['explode'].value, str(explode_val))
+    p.title.text = title
+    p.plot_height = int(wdg['plot_height'].value)
+    p.plot_width = int(wdg['plot_width'].value)
     p.title.text_font_size = wdg['plot_title_size'].value + 'pt'
     p.xaxis.axis_label = wdg['x_title'].value
     p.yaxis.axis_label = wdg['y_title'].value
@@ -412,92 +1119,237 @@ def create_figure(df_exploded, df_plots, wdg, cols, explode_val=None, explode_gr
     p.xaxis.major_label_text_font_size = wdg['x_major_label_size'].value + 'pt'
     p.yaxis.major_label_text_font_size = wdg['y_major_label_size'].value + 'pt'
     p.xaxis.major_label_orientation = 'horizontal' if wdg['x_major_label_orientation'].value == '0' else math.radians(float(wdg['x_major_label_orientation'].value))
-    if wdg['x'].value in cols['continuous']:
-        if wdg['x_min'].value != '': p.x_range.start = float(wdg['x_min'].value)
-        if wdg['x_max'].value != '': p.x_range.end = float(wdg['x_max'].value)
-    if wdg['y'].value in cols['continuous']:
-        if wdg['y_min'].value != '': p.y_range.start = float(wdg['y_min'].value)
-        if wdg['y_max'].value != '': p.y_range.end = float(wdg['y_max'].value)
+    if wdg['x'].value in cols['continuous'] and changed in [None, 'x_min', 'x_max']:
+        p.x_range.start = None if wdg['x_min'].value == '' else float(wdg['x_min'].value)
+        p.x_range.end = None if wdg['x_max'].value == '' else float(wdg['x_max'].value)
+    if wdg['y'].value in cols['continuous'] and changed in [None, 'y_min', 'y_max']:
+        p.y_range.start = None if wdg['y_min'].value == '' else float(wdg['y_min'].value)
+        p.y_range.end = None if wdg['y_max'].value == '' else float(wdg['y_max'].value)
 
-    #Add glyphs to figure
-    c = C_NORM
-    if wdg['series'].value == 'None':
-        if wdg['y_agg'].value != 'None' and wdg['y'].value in cols['continuous']:
-            xs = df_exploded[x_col].values.tolist()
-            ys = df_exploded[wdg['y'].value].values.tolist()
-        add_glyph(wdg, p, xs, ys, c)
-    else:
-        full_series = df_plots[wdg['series'].value].unique().tolist() #for colors only
-        if wdg['chart_type'].value in STACKEDTYPES: #We are stacking the series
-            xs_full = sorted(df_exploded[x_col].unique().tolist())
-            y_bases_pos = [0]*len(xs_full)
-            y_bases_neg = [0]*len(xs_full)
-        for i, ser in enumerate(df_exploded[wdg['series'].value].unique().tolist()):
-            c = COLORS[full_series.index(ser)]
-            df_series = df_exploded[df_exploded[wdg['series'].value].isin([ser])]
-            xs_ser = df_series[x_col].values.tolist()
-            ys_ser = df_series[wdg['y'].value].values.tolist()
-            if wdg['chart_type'].value not in STACKEDTYPES: #The series will not be stacked
-                add_glyph(wdg, p, xs_ser, ys_ser, c, series=ser)
-            else: #We are stacking the series
-                ys_pos = [ys_ser[xs_ser.index(x)] if x in xs_ser and ys_ser[xs_ser.index(x)] > 0 else 0 for i, x in enumerate(xs_full)]
-                ys_neg = [ys_ser[xs_ser.index(x)] if x in xs_ser and ys_ser[xs_ser.index(x)] < 0 else 0 for i, x in enumerate(xs_full)]
-                ys_stacked_pos = [ys_pos[i] + y_bases_pos[i] for i in range(len(xs_full))]
-                ys_stacked_neg = [ys_neg[i] + y_bases_neg[i] for i in range(len(xs_full))]
-                add_glyph(wdg, p, xs_full, ys_stacked_pos, c, y_bases=y_bases_pos, series=ser)
-                add_glyph(wdg, p, xs_full, ys_stacked_neg, c, y_bases=y_bases_neg, series=ser)
-                y_bases_pos = ys_stacked_pos
-                y_bases_neg = ys_stacked_neg
-    return p
+    #Glyph appearance, matching the glyph types created by add_glyph()
+    alpha = float(wdg['opacity'].value)
+    for renderer in p.renderers:
+        glyph = getattr(renderer, 'glyph', None)
+        if isinstance(glyph, bmg.Circle):
+            glyph.size = int(wdg['circle_size'].value)
+            glyph.fill_alpha = alpha
+        elif isinstance(glyph, (bmg.Line, bmg.MultiLine)):
+            glyph.line_alpha = alpha
+            glyph.line_width = float(wdg['line_width'].value)
+        elif isinstance(glyph, bmg.Rect):
+            glyph.width = float(wdg['bar_width'].value)
+            glyph.fill_alpha = alpha
+        elif isinstance(glyph, (bmg.Patch, bmg.Patches)):
+            glyph.fill_alpha = alpha
+            glyph.line_alpha = alpha
 
-def add_glyph(wdg, p, xs, ys, c, y_bases=None, series=None):
+def glyph_data(wdg, xs, ys, y_bases=None, series=None):
     '''
-    Add a glyph to a Bokeh figure, depending on the chosen chart type.
+    Build the ColumnDataSource data of a glyph, depending on the chosen chart type.
 
     Args:
         wdg (ordered dict): Dictionary of bokeh model widgets.
-        p (bokeh.model.figure): Bokeh figure.
         xs (list): List of x-values. These could be numeric or strings.
         ys (list): List of y-values. These could be numeric or strings. If series data is stacked, these values include stacking.
-        c (string): Color to use for this series.
         y_bases (list, optional): Only used when stacking series. This is the previous cumulative stacking level.
         series (string): Name of current series for this glyph.
 
+    Returns:
+        data (dict): Keys are column names and values are numpy arrays. None if a Bar or Area glyph would have no height.
+    '''
+    xs = np.asarray(xs)
+    ys = np.asarray(ys)
+    if y_bases is not None:
+        y_bases = np.asarray(y_bases)
+    y_unstacked = ys if y_bases is None else ys - y_bases
+    ser = np.full(len(xs), 'None' if series is None else series, dtype=object)
+    if wdg['chart_type'].value in ['Dot', 'Line']:
+        return {'x': xs, 'y': ys, 'x_legend': xs, 'y_legend': y_unstacked, 'ser_legend': ser}
+    if not np.any(y_unstacked != 0):
+        return None
+    if y_bases is None:
+        y_bases = np.zeros(len(ys), dtype=ys.dtype)
+    if wdg['chart_type'].value == 'Bar':
+        centers = (ys + y_bases)/2
+        heights = np.abs(ys - y_bases)
+        #bars have issues when height is 0, so remove elements whose height is 0
+        keep = heights != 0
+        return {'x': xs[keep], 'y': centers[keep], 'x_legend': xs[keep], 'y_legend': y_unstacked[keep], 'h': heights[keep], 'ser_legend': ser[keep]}
+    elif wdg['chart_type'].value == 'Area':
+        return {'x': np.concatenate([xs, xs[::-1]]), 'y': np.concatenate([y_bases, ys[::-1]])}
+
+def lod_budget(wdg, cols):
+    '''
+    Return the maximum number of points per figure from the lod_points widget, or 0 if figures are not decimated.
+    Only Dot and Line charts of continuous x and y are decimated.
+    '''
+    if wdg['chart_type'].value not in ['Dot', 'Line'] or wdg['x_group'].value != 'None':
+        return 0
+    if wdg['x'].value not in cols['continuous'] or wdg['y'].value not in cols['continuous']:
+        return 0
+    try:
+        return max(int(wdg['lod_points'].value), 0)
+    except ValueError:
+        return 0
+
+def lod_buckets(wdg, budget, n_glyphs):
+    '''
+    Return the number of x buckets for decimating each glyph of a figure: one per pixel of plot width,
+    but few enough that the figure's glyphs, with up to two points per bucket, stay within budget.
+    '''
+    return max(1, min(int(wdg['plot_width'].value), budget // (2 * max(n_glyphs, 1))))
+
+def lod_data(data, n_buckets, x_start=None, x_end=None):
+    '''
+    Decimate the data of a Dot or Line glyph. The x range is split into n_buckets equal buckets and only the points
+    with the minimum and maximum y of each bucket are kept, so peaks and troughs still show at the plot's resolution.
+    Points outside the x range are dropped, except the closest on each side, so lines still run off the edges.
+
+    Args:
+        data (dict): Full resolution glyph data from glyph_data().
+        n_buckets (int): Number of x buckets.
+        x_start (float, optional): Start of x range. Defaults to the minimum x.
+        x_end (float, optional): End of x range. Defaults to the maximum x.
+
+    Returns:
+        data (dict): Glyph data with the kept points, in their original order.
+    '''
+    xs = data['x']
+    ys = data['y']
+    if len(xs) == 0:
+        return data
+    lo = xs.min() if x_start is None else x_start
+    hi = xs.max() if x_end is None else x_end
+    view = np.flatnonzero((xs >= lo) & (xs <= hi))
+    keep = view
+    if len(view) > 2 * n_buckets:
+        width = (hi - lo) / n_buckets if hi > lo else 1
+        buckets = np.minimum(((xs[view] - lo) / width).astype(np.int64), n_buckets - 1)
+        perm = np.lexsort((ys[view], buckets))
+        starts = np.flatnonzero(np.append(True, buckets[perm][1:] != buckets[perm][:-1]))
+        ends = np.append(starts[1:], len(view)) - 1
+        keep = view[np.union1d(perm[starts], perm[ends])]
+    #closest points outside the range
+    outside = [np.flatnonzero(xs < lo), np.flatnonzero(xs > hi)]
+    edges = [o[np.argmax(xs[o])] for o in outside[:1] if len(o)] + [o[np.argmin(xs[o])] for o in outside[1:] if len(o)]
+    keep = np.union1d(keep, np.array(edges, dtype=np.int64))
+    return dict((k, v[keep]) for k, v in data.items())
+
+def update_lod(p, attr, old, new):
+    '''
+    When the x range of a figure changes, schedule its decimated glyphs to be refined once the range settles.
+    '''
+    if GL['doc'] is None:
+        refine_lod(p)
+        return
+    if p.id in GL['lod_timeouts']:
+        try:
+            GL['doc'].remove_timeout_callback(GL['lod_timeouts'][p.id])
+        except ValueError:
+            pass #already ran
+    GL['lod_timeouts'][p.id] = GL['doc'].add_timeout_callback(partial(refine_lod, p), PLOT_DEBOUNCE_MS)
+
+def refine_lod(p):
+    '''
+    Decimate the full resolution data of a figure's glyphs for its current x range and width, on pivotpool,
+    and send the result to the figure's data sources. Merged glyphs are decimated series by series and merged again.
+    '''
+    GL['lod_timeouts'].pop(p.id, None)
+    if GL['specs'] is None or p not in GL['plots'].children:
+        return
+    spec = GL['specs'][GL['plots'].children.index(p)]
+    budget = lod_budget(GL['widgets'], GL['columns'])
+    glyph_parts = [g.get('parts', [g]) for g in spec['glyphs']]
+    if not budget or not any('full' in part for parts in glyph_parts for part in parts):
+        return
+    n_buckets = lod_buckets(GL['widgets'], budget, sum(len(parts) for parts in glyph_parts))
+    x_start, x_end = p.x_range.start, p.x_range.end
+    chart_type = GL['widgets']['chart_type'].value
+    gen = GL['plot_gen']
+    def refine():
+        datas = []
+        for g in spec['glyphs']:
+            if 'parts' in g and any('full' in part for part in g['parts']):
+                part_datas = [lod_data(part['full'], n_buckets, x_start, x_end) if 'full' in part else part['data'] for part in g['parts']]
+                datas.append(merge_glyph_data(part_datas, [part['color'] for part in g['parts']], [part['series'] for part in g['parts']],
+                    chart_type))
+            else:
+                datas.append(lod_data(g['full'], n_buckets, x_start, x_end) if 'full' in g else None)
+        if GL['doc'] is None:
+            apply_lod(gen, p, datas)
+        else:
+            GL['doc'].add_next_tick_callback(partial(apply_lod, gen, p, datas))
+    if GL['doc'] is None:
+        refine()
+    else:
+        pivotpool.submit(refine)
+
+def apply_lod(gen, p, datas):
+    '''
+    Send refined glyph data from refine_lod() to a figure, unless the plots have been rebuilt since.
+    '''
+    if gen != GL['plot_gen']:
+        return
+    for renderer, data in zip(p.renderers, datas):
+        if data is not None:
+            renderer.data_source.data = data
+
+def add_glyph(wdg, p, glyph):
+    '''
+    Add a glyph to a Bokeh figure, depending on the chosen chart type.
+
+    Args:
+        wdg (ordered dict): Dictionary of bokeh model widgets.
+        p (bokeh.model.figure): Bokeh figure.
+        glyph (dict): Glyph from figure_data(), with the 'color' and ColumnDataSource 'data' of the glyph.
+
     Returns:
         Nothing.
     '''
     alpha = float(wdg['opacity'].value)
-    y_unstacked = list(ys) if y_bases is None else [ys[i] - y_bases[i] for i in range(len(ys))]
-    ser = ['None']*len(xs) if series is None else [series]*len(xs)
+    source = bms.ColumnDataSource(glyph['data'])
+    if 'parts' in glyph:
+        add_merged_glyph(wdg, p, source)
+        return
+    c = glyph['color']
     if wdg['chart_type'].value == 'Dot':
-        source = bms.ColumnDataSource({'x': xs, 'y': ys, 'x_legend': xs, 'y_legend': y_unstacked, 'ser_legend': ser})
         p.circle('x', 'y', source=source, color=c, size=int(wdg['circle_size'].value), fill_alpha=alpha, line_color=None, line_width=None)
     elif wdg['chart_type'].value == 'Line':
-        source = bms.ColumnDataSource({'x': xs, 'y': ys, 'x_legend': xs, 'y_legend': y_unstacked, 'ser_legend': ser})
         p.line('x', 'y', source=source, color=c, alpha=alpha, line_width=float(wdg['line_width'].value))
-    elif wdg['chart_type'].value == 'Bar' and y_unstacked != [0]*len(y_unstacked):
-        if y_bases is None: y_bases = [0]*len(ys)
-        centers = [(ys[i] + y_bases[i])/2 for i in range(len(ys))]
-        heights = [abs(ys[i] - y_bases[i]) for i in range(len(ys))]
-        #bars have issues when height is 0, so remove elements whose height is 0 
-        heights_orig = list(heights) #we make a copy so we aren't modifying the list we are iterating on.
-        xs_cp = list(xs) #we don't want to modify xs that are passed into function
-        for i, h in reversed(list(enumerate(heights_orig))):
-            if h == 0:
-                del xs_cp[i]
-                del centers[i]
-                del heights[i]
-                del y_unstacked[i]
-                del ser[i]
-        source = bms.ColumnDataSource({'x': xs_cp, 'y': centers, 'x_legend': xs_cp, 'y_legend': y_unstacked, 'h': heights, 'ser_legend': ser})
+    elif wdg['chart_type'].value == 'Bar':
         p.rect('x', 'y', source=source, height='h', color=c, fill_alpha=alpha, width=float(wdg['bar_width'].value), line_color=None, line_width=None)
-    elif wdg['chart_type'].value == 'Area' and y_unstacked != [0]*len(y_unstacked):
-        if y_bases is None: y_bases = [0]*len(ys)
-        xs_around = xs + xs[::-1]
-        ys_around = y_bases + ys[::-1]
-        source = bms.ColumnDataSource({'x': xs_around, 'y': ys_around})
+    elif wdg['chart_type'].value == 'Area':
         p.patch('x', 'y', source=source, alpha=alpha, fill_color=c, line_color=None, line_width=None)
 
+def add_merged_glyph(wdg, p, source):
+    '''
+    Add a glyph that draws all series of a figure, from merge_glyph_data(), colored by its color column.
+    '''
+    alpha = float(wdg['opacity'].value)
+    c = {'field': 'color'}
+    if wdg['chart_type'].value == 'Dot':
+        p.circle('x', 'y', source=source, fill_color=c, size=int(wdg['circle_size'].value), fill_alpha=alpha, line_color=None, line_width=None)
+    elif wdg['chart_type'].value == 'Line':
+        p.multi_line('xs', 'ys', source=source, line_color=c, line_alpha=alpha, line_width=float(wdg['line_width'].value))
+    elif wdg['chart_type'].value == 'Bar':
+        p.rect('x', 'y', source=source, height='h', fill_color=c, fill_alpha=alpha, width=float(wdg['bar_width'].value), line_color=None, line_width=None)
+    elif wdg['chart_type'].value == 'Area':
+        p.patches('xs', 'ys', source=source, fill_color=c, fill_alpha=alpha, line_alpha=alpha, line_color=None, line_width=None)
+
+def layout_key(specs, wdg):
+    '''
+    Return a hashable description of the figures and glyphs that would be created from a list of figure specs.
+    If it is unchanged from the figures currently shown, their data sources can be updated in place. Figures keep
+    their ranges, which the browser stops fitting to the data once the user zooms or pans, so widgets that change
+    what the axes measure (AXIS_WIDGETS) are part of the key, and changing them rebuilds the figures.
+    '''
+    figs = []
+    for spec in specs:
+        ranges = tuple((k, tuple(v)) for k, v in sorted(spec['kw'].items()))
+        glyphs = tuple((g['series'], g['color'], tuple(sorted(g['data']))) for g in spec['glyphs'])
+        figs.append((spec['explode_val'], spec['explode_group'], ranges, glyphs))
+    return (wdg['chart_type'].value, wdg['render_mode'].value, wdg['output_backend'].value,
+        tuple(wdg[name].value for name in AXIS_WIDGETS), tuple(figs))
 
 def build_series_legend(df_plots, series_val):
     '''
@@ -520,27 +1372,21 @@ def build_series_legend(df_plots, series_val):
     return series_legend_string
 
 
-def wavg(group, avg_name, weight_name):
-    """ http://pbpython.com/weighted-average.html
-    """
-    d = group[avg_name]
-    w = group[weight_name]
-    try:
-        return (d * w).sum() / w.sum()
-    except ZeroDivisionError:
-        return 0
-
-
 def update_data(attr, old, new):
     '''
-    When data source is updated, rebuild widgets and plots.
+    When data source is updated, clear widgets and plots, and load the new data source in the background.
     '''
     GL['widgets'] = GL['top_wdg'].copy()
-    if GL['widgets']['data'].value != '':
-        GL['df_source'], GL['columns'] = get_data(GL['widgets']['data'].value)
-        GL['widgets'].update(build_widgets(GL['df_source'], GL['columns']))
     GL['controls'].children = list(GL['widgets'].values())
     GL['plots'].children = []
+    GL['layout'] = None
+    GL['plot_gen'] += 1
+    GL['filter_open'] = None
+    if GL['widgets']['data'].value != '':
+        load_source(GL['widgets']['data'].value)
+    else:
+        GL['load_id'] += 1
+        GL['top_wdg']['load_progress'].text = ''
 
 def update_wdg(attr, old, new):
     '''
@@ -548,6 +1394,15 @@ def update_wdg(attr, old, new):
     '''
     update_plots()
 
+def update_wdg_style(name, attr, old, new):
+    '''
+    When widget name (in WDG_STYLE) is updated, restyle the existing figures in place rather than rebuilding them.
+    '''
+    for p in GL['plots'].children:
+        style_figure(p, GL['widgets'], GL['columns'], p.tags[0], p.tags[1], name)
+        #plot width sets the resolution of decimated glyphs
+        update_lod(p, 'plot_width', None, p.plot_width)
+
 def update_wdg_col(attr, old, new):
     '''
     When widgets in WDG_COL are updated, set the options of all WDG_COL widgets,
@@ -562,8 +1417,110 @@ def update_adv_col(attr, old, new):
     '''
     wdg = GL['widgets']
     df = GL['df_source']
-    if wdg['adv_col'].value != 'None':
-        wdg['adv_col_base'].options = ['None'] + ADV_BASES + [str(i) for i in sorted(df[wdg['adv_col'].value].unique().tolist())]
+    col = wdg['adv_col'].value
+    if col != 'None':
+        if col in GL['columns']['values']:
+            val_list = GL['columns']['values'][col]
+        elif isinstance(df, lazyq.LazySource):
+            val_list = df.unique_values(col)
+        else:
+            val_list = sorted(df[col].unique().tolist())
+        wdg['adv_col_base'].options = ['None'] + ADV_BASES + [str(i) for i in val_list]
+
+def open_filter(j):
+    '''
+    When a filter heading is clicked, show the first page of that filter's values in the filter editor.
+    '''
+    wdg = GL['widgets']
+    col = GL['columns']['filterable'][j]
+    labels = [str(i) for i in GL['columns']['values'][col]]
+    GL['filter_open'] = {'col': col, 'labels': labels, 'matches': range(len(labels)), 'page': 0, 'codes': []}
+    wdg['filter_title'].text = '<b>' + col + '</b>'
+    wdg['filter_search'].value = ''
+    show_filter_page()
+
+def update_filter_search(attr, old, new):
+    '''
+    When the filter editor's search text changes, show only the values of the open filter that contain it, ignoring case.
+    '''
+    fo = GL['filter_open']
+    if fo is None:
+        return
+    text = new.strip().lower()
+    fo['matches'] = [i for i, label in enumerate(fo['labels']) if text in label.lower()] if text else range(len(fo['labels']))
+    fo['page'] = 0
+    show_filter_page()
+
+def page_filter(step):
+    '''
+    Show the next (step=1) or previous (step=-1) page of values in the filter editor.
+    '''
+    if GL['filter_open'] is not None:
+        GL['filter_open']['page'] += step
+        show_filter_page()
+
+def show_filter_page():
+    '''
+    Show the current page of the open filter's matching values in the filter editor, checked unless excluded.
+    '''
+    wdg = GL['widgets']
+    fo = GL['filter_open']
+    n_pages = max(1, int(math.ceil(len(fo['matches']) / FILTER_PAGE_SIZE)))
+    fo['page'] = min(max(fo['page'], 0), n_pages - 1)
+    start = fo['page'] * FILTER_PAGE_SIZE
+    fo['codes'] = list(fo['matches'][start:start + FILTER_PAGE_SIZE])
+    excluded = set(filter_excluded(wdg, GL['columns']).get(fo['col'], []))
+    wdg['filter_values'].labels = [fo['labels'][i] for i in fo['codes']]
+    wdg['filter_values'].active = [i for i, code in enumerate(fo['codes']) if code not in excluded]
+    show_filter_status()
+
+def show_filter_status():
+    fo = GL['filter_open']
+    start = fo['page'] * FILTER_PAGE_SIZE
+    n_excluded = len(filter_excluded(GL['widgets'], GL['columns']).get(fo['col'], []))
+    GL['widgets']['filter_page'].text = '%d-%d of %d values, %d excluded' % (min(start + 1, len(fo['matches'])),
+        start + len(fo['codes']), len(fo['matches']), n_excluded)
+
+def update_filter_values(attr, old, new):
+    '''
+    When values in the filter editor are checked or unchecked, update the excluded codes of the open filter.
+    As before, plots are only updated with the Update Filters button.
+    '''
+    fo = GL['filter_open']
+    if fo is None:
+        return
+    excluded = set(filter_excluded(GL['widgets'], GL['columns']).get(fo['col'], []))
+    active = set(new)
+    for i, code in enumerate(fo['codes']):
+        if i in active:
+            excluded.discard(code)
+        else:
+            excluded.add(code)
+    set_open_excluded(excluded)
+
+def select_filter_values(keep):
+    '''
+    Check (keep=True) or uncheck all values of the open filter that match the search, on every page.
+    '''
+    fo = GL['filter_open']
+    if fo is None:
+        return
+    excluded = set(filter_excluded(GL['widgets'], GL['columns']).get(fo['col'], []))
+    if keep:
+        excluded.difference_update(fo['matches'])
+    else:
+        excluded.update(fo['matches'])
+    set_open_excluded(excluded)
+    show_filter_page()
+
+def set_open_excluded(excluded):
+    '''
+    Set the excluded codes of the open filter, keeping those of the other filters.
+    '''
+    all_excluded = filter_excluded(GL['widgets'], GL['columns'])
+    all_excluded[GL['filter_open']['col']] = excluded
+    set_filter_excluded(GL['widgets'], GL['columns'], all_excluded)
+    show_filter_status()
 
 def set_wdg_col_options():
     '''
@@ -584,21 +1541,154 @@ def set_wdg_col_options():
 
 def update_plots():
     '''
-    Make sure x axis and y axis are set. If so, set the dataframe for the plots and build them.
+    Make sure x axis and y axis are set. If so, schedule the plots to be rebuilt once widgets have stopped
+    changing for PLOT_DEBOUNCE_MS. Every call starts a new plot generation, so work for older widget states
+    that is still waiting or running is dropped. Without a bokeh document (e.g. when called from scripts),
+    plots are rebuilt right away.
     '''
+    GL['plot_gen'] += 1
     if GL['widgets']['x'].value == 'None' or GL['widgets']['y'].value == 'None':
         GL['plots'].children = []
+        GL['layout'] = None
+        return
+    if GL['doc'] is None:
+        wdg = snapshot_widgets(GL['widgets'])
+        profile = pivotprof.new_profile('update_plots')
+        df_plots = set_df_plots(GL['df_source'], GL['columns'], wdg, GL['stage_cache'], profile=profile)
+        specs = pivotprof.stage(profile, 'figure_specs', figure_specs, df_plots, wdg, GL['columns'])
+        apply_plots(GL['plot_gen'], wdg, df_plots, specs, profile)
+        return
+    if GL['plot_timeout'] is not None:
+        try:
+            GL['doc'].remove_timeout_callback(GL['plot_timeout'])
+        except ValueError:
+            pass #already ran
+    GL['plot_timeout'] = GL['doc'].add_timeout_callback(partial(submit_plots, GL['plot_gen']), PLOT_DEBOUNCE_MS)
+
+def submit_plots(gen):
+    '''
+    Once widgets have settled, send the computation of the plots for the current widget values to pivotpool.
+    Widget values are copied here, on the document's thread, so that the worker sees one consistent widget state.
+    '''
+    GL['plot_timeout'] = None
+    if gen == GL['plot_gen']:
+        pivotpool.submit(compute_plots, gen, snapshot_widgets(GL['widgets']))
+
+def compute_plots(gen, wdg):
+    '''
+    Run on a pivotpool worker. Compute the dataframe and figure specs for plot generation gen, and hand them to
+    apply_plots() on the document's thread. Work for a session runs one generation at a time, and stops early once
+    a newer generation has started.
+
+    Args:
+        gen (int): Plot generation.
+        wdg (ordered dict): Widget state from snapshot_widgets().
+    '''
+    cancelled = lambda: gen != GL['plot_gen']
+    profile = pivotprof.new_profile('update_plots')
+    with GL['plot_lock']:
+        if cancelled():
+            return
+        df_plots = set_df_plots(GL['df_source'], GL['columns'], wdg, GL['stage_cache'], cancelled, profile)
+        if df_plots is None or cancelled():
+            return
+        specs = pivotprof.stage(profile, 'figure_specs', figure_specs, df_plots, wdg, GL['columns'])
+    GL['doc'].add_next_tick_callback(partial(apply_plots, gen, wdg, df_plots, specs, profile))
+
+def apply_plots(gen, wdg, df_plots, specs, profile=None):
+    '''
+    Show computed plots, unless a newer plot generation has started. If the figures and their glyphs are
+    the same as those shown, only their data sources are updated. Otherwise figures are rebuilt.
+    When profiling, the profile is finished with the time spent here and in serializing glyph data.
+    '''
+    if gen != GL['plot_gen']:
         return
-    GL['df_plots'] = set_df_plots(GL['df_source'], GL['columns'], GL['widgets'])
-    GL['widgets']['series_legend'].text = build_series_legend(GL['df_plots'], GL['widgets']['series'].value)
-    GL['plots'].children = create_figures(GL['df_plots'], GL['widgets'], GL['columns'])
+    GL['df_plots'] = df_plots
+    GL['specs'] = specs
+    GL['widgets']['series_legend'].text = build_series_legend(df_plots, wdg['series'].value)
+    layout = layout_key(specs, wdg)
+    if layout == GL['layout']:
+        #The same figures and glyphs are shown, so only send new data to their existing sources.
+        pivotprof.stage(profile, 'update_sources', update_sources, specs)
+    else:
+        new_figure = lambda spec: create_figure(spec, GL['widgets'], GL['columns'])
+        GL['plots'].children = pivotprof.stage(profile, 'create_figures', lambda specs: [new_figure(spec) for spec in specs], specs)
+        GL['layout'] = layout
+    if profile is not None:
+        profile_serialization(profile, specs)
+        if 'diagnostics' in GL['widgets']:
+            GL['widgets']['diagnostics'].text = pivotprof.finish(profile)
+
+def update_sources(specs):
+    '''
+    Send the glyph data of specs to the data sources of the figures shown, which have the same layout.
+    '''
+    for p, spec in zip(GL['plots'].children, specs):
+        for renderer, glyph in zip(p.renderers, spec['glyphs']):
+            renderer.data_source.data = glyph['data']
+        #the figure may be zoomed in, so refine any decimated glyphs for its x range
+        update_lod(p, 'start', None, p.x_range.start)
+    return GL['plots'].children
+
+def profile_serialization(profile, specs):
+    '''
+    Record the time taken to encode the glyph data of specs the way bokeh does when sending data sources to
+    the browser, and the size of the encoded data. Bokeh serializes after the callback returns, so it is
+    measured separately here.
+    '''
+    start = time.time()
+    n_bytes = sum(len(json.dumps(transform_column_source_data(g['data']))) for spec in specs for g in spec['glyphs'])
+    pivotprof.record(profile, 'serialize', time.time() - start, rows_out=sum(glyph_points(g['data']) for spec in specs for g in spec['glyphs']), bytes=n_bytes)
+
+def snapshot_widgets(wdg):
+    '''
+    Copy the values (and text, for the filter state) of widgets, so that plots can be computed off the
+    document's thread while the widgets themselves keep changing.
+
+    Returns:
+        wdg (ordered dict): Keys are widget names, and values are WidgetState tuples with the same value and text
+            attributes as the widgets.
+    '''
+    return collections.OrderedDict((key, WidgetState(getattr(w, 'value', None), getattr(w, 'text', None)))
+        for key, w in wdg.items())
 
 def download():
     '''
-    Download a csv file of the currently viewed data to the downloads/ directory,
-    with the current timestamp.
+    Export the currently viewed data in the chosen format on pivotpool, so that large exports don't block the
+    session, and link to the file (which the browser then downloads) once it is written.
+    '''
+    if GL['df_plots'] is None:
+        return
+    wdg = GL['widgets']
+    GL['export_id'] += 1
+    split_cols = None
+    if wdg['export_split'].value == 'File Per Chart':
+        #each chart has the rows of one explode value, within one explode group if they are grouped
+        split_cols = [wdg[name].value for name in ['explode_group', 'explode'] if wdg[name].value in GL['df_plots'].columns]
+    wdg['export_status'].text = 'Exporting %d rows...' % len(GL['df_plots'])
+    pivotpool.submit(export_plots, GL['export_id'], GL['df_plots'], wdg['export_format'].value, split_cols or None)
+
+def export_plots(export_id, df_plots, fmt, split_cols):
+    '''
+    Run on a pivotpool worker. Write df_plots with exports.export() and report the result in export_status.
+    '''
+    try:
+        filename = exports.export(df_plots, fmt, split_cols)
+        text = '<a class="export-link" href="%s%s" download="%s">%s</a> (%.1f MB)' % (exports.URL_PATH, filename,
+            filename, filename, exports.file_size(filename) / 1024 / 1024)
+    except Exception as e:
+        _logger.exception('Error exporting data')
+        text = 'Error exporting data: ' + str(e)
+    GL['doc'].add_next_tick_callback(partial(set_export_status, export_id, text))
+
+def set_export_status(export_id, text):
+    '''
+    Set the text of the export_status widget, unless a newer export has started.
     '''
-    GL['df_plots'].to_csv(os.path.dirname(os.path.realpath(__file__)) + '/downloads/out '+
-        datetime.datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")+'.csv', index=False)
+    if export_id == GL['export_id'] and 'export_status' in GL['widgets']:
+        GL['widgets']['export_status'].text = text
 
-initialize()
+#bokeh serve runs this file as a module named bk_script_... (bokeh_app_... in newer bokeh versions). Other scripts, like
+#the benchmarks, import it to reuse the pivot functions without a bokeh session, so only initialize when run by the server.
+if __name__.startswith(('bk_script', 'bokeh_app')):
+    initialize()
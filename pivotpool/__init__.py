@@ -0,0 +1,31 @@
+'''
+Process-wide pool of worker threads that compute pivots off the bokeh server's event loop. Like srccache,
+this module is imported once per server process, so all sessions share one pool of WORKERS threads
+(SUPERPIVOT_WORKERS environment variable), and one session's heavy pivot no longer blocks the others.
+Threads rather than processes are used so that workers can read the source frames shared in srccache
+without copying them, and pandas and numpy release the GIL for most of the heavy work.
+'''
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = int(os.environ.get('SUPERPIVOT_WORKERS', 4))
+
+_executor = ThreadPoolExecutor(max_workers=WORKERS)
+_logger = logging.getLogger('superpivot')
+
+def submit(func, *args):
+    '''
+    Run func(*args) on the pool. Exceptions raised by func are logged, since nothing waits on the result.
+
+    Returns:
+        future (concurrent.futures.Future): Future of the call.
+    '''
+    return _executor.submit(_run, func, args)
+
+def _run(func, args):
+    try:
+        return func(*args)
+    except Exception:
+        _logger.exception('Error in %s', func.__name__)
+        raise
@@ -0,0 +1,95 @@
+'''
+Optional profiling of plot updates, turned on with the SUPERPIVOT_PROFILE=1 environment variable. A profile records
+the wall time, rows entering and leaving, and change in traced memory of each stage of an update. Finished profiles
+are logged as one json line each on the 'superpivot.profile' logger, and summarized as html for the app's
+diagnostics panel. When profiling is off, new_profile() returns None and stage() just calls the stage function,
+so there is no overhead.
+
+Memory is measured with tracemalloc, which traces the whole process, so deltas include allocations made at the
+same time by other sessions' threads.
+'''
+import os
+import json
+import time
+import logging
+
+ENABLED = os.environ.get('SUPERPIVOT_PROFILE', '0') not in ['', '0']
+
+_logger = logging.getLogger('superpivot.profile')
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+if ENABLED and tracemalloc is not None and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+def new_profile(label, **fields):
+    '''
+    Return a new profile, or None if profiling is off.
+
+    Args:
+        label (string): What is being profiled, e.g. 'update_plots'.
+        fields: Extra fields to include in the log line.
+    '''
+    if not ENABLED:
+        return None
+    profile = {'label': label, 'stages': [], 'start': time.time()}
+    profile.update(fields)
+    return profile
+
+def stage(profile, name, func, *args):
+    '''
+    Call func(*args) and return its result. If profile is not None, record the time taken, the length (rows, or
+    e.g. figures) of the first argument and of the result, and the change in traced memory in kB.
+    '''
+    if profile is None:
+        return func(*args)
+    mem_start = _traced()
+    start = time.time()
+    result = func(*args)
+    record(profile, name, time.time() - start, _len(args[0]) if args else None, _len(result), _traced() - mem_start)
+    return result
+
+def record(profile, name, seconds, rows_in=None, rows_out=None, mem_kb=None, **fields):
+    '''
+    Add a stage that was timed by the caller to a profile. Does nothing if profile is None.
+    '''
+    if profile is None:
+        return
+    entry = {'stage': name, 'seconds': round(seconds, 6), 'rows_in': rows_in, 'rows_out': rows_out,
+        'mem_kb': None if mem_kb is None else round(mem_kb, 1)}
+    entry.update(fields)
+    profile['stages'].append(entry)
+
+def finish(profile):
+    '''
+    Log a finished profile as a json line, and return an html table of its stages for the diagnostics panel.
+    Returns '' if profile is None.
+    '''
+    if profile is None:
+        return ''
+    out = dict((k, v) for k, v in profile.items() if k != 'start')
+    out['seconds'] = round(time.time() - profile['start'], 6)
+    _logger.info(json.dumps(out, default=str))
+    html = '<table class="diagnostics-table"><tr><th>Stage</th><th>ms</th><th>Rows in</th><th>Rows out</th><th>kB</th></tr>'
+    for entry in profile['stages']:
+        ms = 'cached' if entry.get('cached') else '%.1f' % (entry['seconds'] * 1000)
+        html += '<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>' % (entry['stage'], ms,
+            _cell(entry['rows_in']), _cell(entry['rows_out']), _cell(entry['mem_kb']))
+    html += '<tr><td><b>Total</b></td><td><b>%.1f</b></td><td></td><td></td><td></td></tr></table>' % (out['seconds'] * 1000)
+    return html
+
+def _traced():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return 0
+    return tracemalloc.get_traced_memory()[0] / 1024
+
+def _len(obj):
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+def _cell(val):
+    return '' if val is None else str(val)
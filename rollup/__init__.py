@@ -0,0 +1,119 @@
+'''
+Rollup cube for answering Sum, Ave and Count pivots without rescanning the rows of large sources. The cube holds
+the sums of every continuous column, and the number of rows, for each combination of values of the filterable
+columns (the finest grain of the dimensions that can be filtered, grouped by, or used as series) that occurs in
+the source. Groups are keyed by the codes of the filter index (see main.build_filter_index()), so filters are
+applied to the cube's keys in the same way they are applied to the source's rows, and any grouping by filterable
+columns is a rollup of the cube.
+
+A source's cube is built on the first query that can use it, and kept in srccache as a value derived from the
+source, so it is shared by all sessions, counts against the cache's memory budget, and is dropped with the source.
+Sources with fewer than MIN_ROWS rows (SUPERPIVOT_ROLLUP_MIN_ROWS environment variable) are fast enough to aggregate
+directly, and no cube is kept for sources where it would not have at most 1/MIN_REDUCTION as many rows as the source.
+'''
+from __future__ import division
+import os
+import numpy as np
+import pandas as pd
+import srccache
+
+MIN_ROWS = int(float(os.environ.get('SUPERPIVOT_ROLLUP_MIN_ROWS', 1000000)))
+MIN_REDUCTION = 4
+AGGREGATIONS = ['Sum', 'Ave', 'Count']
+
+def can_use(df_source, cols, groupby_cols, y, agg, scales):
+    '''
+    Return True if a pivot of df_source may be answered from its cube. The cube itself may still turn out
+    not to be worth keeping, in which case get_cube() returns None. Scaling a grouped column by 0 would merge
+    its groups, so isn't answered from the cube.
+    '''
+    return (isinstance(df_source, pd.DataFrame) and len(df_source) >= MIN_ROWS and 'filter_index' in cols and
+        agg in AGGREGATIONS and y in cols['continuous'] and all(c in cols['filterable'] for c in groupby_cols) and
+        all(scales.get(c, 1) != 0 for c in groupby_cols))
+
+def get_cube(df_source, cols):
+    '''
+    Return the cube of a source, building it on first use, or None if the cube is not worth keeping.
+    '''
+    return srccache.get_derived(df_source, 'rollup', build_cube, cube_bytes, df_source, cols)
+
+def cube_bytes(cube):
+    '''
+    Return the number of bytes held by a cube (0 for None).
+    '''
+    if cube is None:
+        return 0
+    return int(cube['codes'].memory_usage(index=True).sum() + cube['sums'].memory_usage(index=True).sum() + cube['count'].nbytes)
+
+def build_cube(df_source, cols):
+    '''
+    Group the rows of a source by the filter index codes of all filterable columns, and sum every continuous column.
+
+    Returns:
+        cube (dict): 'codes' is a dataframe of the codes of each filterable column, 'sums' a dataframe of the sums
+            of each continuous column, and 'count' an array of the number of rows, with one row per group. 'dtypes'
+            holds the dtypes of the filterable columns. None if there would be more than len(df_source) / MIN_REDUCTION
+            groups.
+    '''
+    dims = cols['filterable']
+    keys = [pd.Series(cols['filter_index'][c], name=c) for c in dims]
+    grouped = df_source[cols['continuous']].groupby(keys, sort=False)
+    count = grouped.size()
+    if len(count) * MIN_REDUCTION > len(df_source):
+        return None
+    sums = grouped.sum()
+    index = sums.index if isinstance(sums.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([sums.index])
+    codes = pd.DataFrame(dict((c, index.get_level_values(c).values) for c in dims), columns=dims)
+    dtypes = dict((c, df_source[c].dtype) for c in dims)
+    return {'codes': codes, 'sums': sums.reset_index(drop=True), 'count': count.values, 'dtypes': dtypes}
+
+def query(cube, cols, groupby_cols, y, agg, excluded, scales):
+    '''
+    Answer a pivot from a cube, with the same result as filtering, scaling and aggregating the source.
+
+    Args:
+        cube (dict): Cube from get_cube().
+        cols (dict): Column classification of the source.
+        groupby_cols (list): Filterable columns to group by.
+        y (string): Continuous column to aggregate.
+        agg (string): 'Sum', 'Ave' or 'Count'.
+        excluded (dict): Keys are filterable columns, and values are lists of excluded codes.
+        scales (dict): Keys are continuous columns, and values are the factors they are multiplied by.
+
+    Returns:
+        df_plots (pandas dataframe): One row per group, with groupby_cols and the aggregated y column.
+    '''
+    codes = cube['codes']
+    mask = None
+    for col, excl in excluded.items():
+        keep = np.ones(len(cols['values'][col]), dtype=bool)
+        keep[excl] = False
+        col_mask = keep[codes[col].values]
+        mask = col_mask if mask is None else mask & col_mask
+    measures = pd.DataFrame({'sum': cube['sums'][y].values, 'count': cube['count']}, columns=['sum', 'count'])
+    keys = [codes[c] for c in groupby_cols]
+    if mask is not None:
+        measures = measures[mask]
+        keys = [k[mask] for k in keys]
+    rolled = measures.groupby(keys, sort=False).sum()
+    index = rolled.index if isinstance(rolled.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([rolled.index])
+    df_plots = pd.DataFrame()
+    for col in groupby_cols:
+        values = cols['values'][col]
+        group_codes = index.get_level_values(col).values
+        if col in cols['discrete']:
+            df_plots[col] = pd.Categorical.from_codes(group_codes, categories=values)
+        else:
+            df_plots[col] = np.asarray(values, dtype=cube['dtypes'][col])[group_codes]
+        if col in scales:
+            df_plots[col] = df_plots[col] * scales[col]
+    if agg == 'Sum':
+        result = rolled['sum'].values
+    elif agg == 'Ave':
+        result = rolled['sum'].values / rolled['count'].values
+    else:
+        result = rolled['count'].values
+    if y in scales and agg != 'Count':
+        result = result * scales[y]
+    df_plots[y] = result
+    return df_plots
@@ -0,0 +1,299 @@
+'''
+Process-wide cache of loaded data sources. Bokeh re-executes main.py for every session, but
+imported modules like this one are only loaded once per server process, so all sessions share
+the frames held here instead of each parsing and holding its own copy.
+
+Entries are keyed by real path, file mtime, file size and (for gdx files) parameter name, so an
+edited source file is reloaded on next access. Least recently used entries are evicted once the
+total size of cached frames exceeds MAX_BYTES (SUPERPIVOT_CACHE_MB environment variable).
+Cached frames are shared between sessions and must not be modified in place. Values derived from a
+cached source, like its rollup cube, can be cached with get_derived(). They count against the same budget,
+and are dropped along with their source.
+
+Optionally (SUPERPIVOT_SIDECAR=1, requires pyarrow), cleaned frames are also written to an on-disk
+feather sidecar next to the source, <file>.superpivot.feather, with discrete columns stored as
+categoricals and the column classification in the file's schema metadata. Later loads of the
+unchanged source, including after a server restart, memory-map the sidecar instead of parsing.
+'''
+import os
+import json
+import hashlib
+import threading
+import collections
+import numpy as np
+
+MAX_BYTES = int(float(os.environ.get('SUPERPIVOT_CACHE_MB', 4096)) * 1024 * 1024)
+SIDECAR = os.environ.get('SUPERPIVOT_SIDECAR', '0') not in ['', '0']
+SIDECAR_VERSION = 1
+
+_entries = collections.OrderedDict()
+_sizes = {}
+_key_locks = {}
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def make_key(path, param=None):
+    '''
+    Build a cache key for a source file.
+
+    Args:
+        path (string): Path to the source file.
+        param (string, optional): Parameter name, for gdx files.
+
+    Returns:
+        key (tuple): (real path, mtime, size, param).
+    '''
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return (path, stat.st_mtime, stat.st_size, param)
+
+def make_multi_key(source, paths, param=None):
+    '''
+    Build a cache key for a source of several files, e.g. a glob pattern. The key changes when any file
+    changes or when the pattern matches different files.
+
+    Args:
+        source (string): The glob pattern or list of paths, as entered.
+        paths (list): Paths to the files of the source.
+        param (string, optional): Parameter name, for gdx files.
+
+    Returns:
+        key (tuple): (source, tuple of (real path, mtime) of each file, total size, param).
+    '''
+    keys = [make_key(path) for path in paths]
+    return (source, tuple((k[0], k[1]) for k in keys), sum(k[2] for k in keys), param)
+
+def get(key, loader, *args):
+    '''
+    Return the cached (df_source, cols) for key, calling loader(*args) to build it on a miss.
+    Concurrent requests for the same key wait for a single load rather than parsing twice.
+
+    Args:
+        key (tuple): Cache key from make_key().
+        loader (function): Returns a (df_source, cols) tuple.
+        args: Arguments passed to loader.
+
+    Returns:
+        df_source (pandas dataframe): Read-only shared dataframe.
+        cols (dict): Column classification returned by loader.
+    '''
+    def load():
+        df_source, cols = loader(*args)
+        #lazy sources (see lazyq) hold no data, so don't count against the budget
+        size = int(df_source.memory_usage(index=True, deep=True).sum()) if hasattr(df_source, 'memory_usage') else 0
+        freeze(df_source)
+        return ((df_source, cols), size)
+    return _get_or_build(key, load, replaces=lambda k: not _is_derived(k) and k[0] == key[0] and k[3] == key[3])
+
+def get_derived(df_source, name, builder, size, *args):
+    '''
+    Return a value derived from a cached source, e.g. its rollup cube, calling builder(*args) to build it on first
+    use. Builds for different sources or names run concurrently, and concurrent requests for the same value wait
+    for a single build. If df_source is not (or no longer) cached, the value is built but not kept.
+
+    Args:
+        df_source (pandas dataframe): Source returned by get().
+        name (string): Name of the derived value.
+        builder (function): Returns the value, which may be None.
+        size (function): Returns the number of bytes held by a value.
+        args: Arguments passed to builder.
+
+    Returns:
+        value: Value returned by builder, shared between sessions.
+    '''
+    with _lock:
+        source_key = next((k for k in _entries if not _is_derived(k) and _entries[k][0] is df_source), None)
+    if source_key is None:
+        return builder(*args)
+    def build():
+        value = builder(*args)
+        return (value, size(value))
+    return _get_or_build((source_key, name), build, source_key=source_key)
+
+def _is_derived(key):
+    return isinstance(key[0], tuple)
+
+def _get_or_build(key, build, replaces=None, source_key=None):
+    '''
+    Return the cached value for key, or call build() for a (value, size) tuple and cache the value.
+    replaces(key) is True for keys of entries that the new entry replaces. Derived values are only
+    stored if their source (source_key) is still cached.
+    '''
+    with _lock:
+        if key in _entries:
+            return _lookup(key)
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with _lock:
+            if key in _entries:
+                return _lookup(key)
+            _stats['misses'] += 1
+        try:
+            value, size = build()
+            with _lock:
+                if replaces is not None:
+                    #drop entries for older versions of the same file
+                    for stale in [k for k in _entries if replaces(k)]:
+                        _remove(stale)
+                if source_key is None or source_key in _entries:
+                    if source_key is not None:
+                        #keep the source ahead of its derived value in least recently used order
+                        _entries[source_key] = _entries.pop(source_key)
+                    _entries[key] = value
+                    _sizes[key] = size
+                    _evict(keep=key)
+        finally:
+            with _lock:
+                _key_locks.pop(key, None)
+    return value
+
+def _lookup(key):
+    #caller must hold _lock and check that key is cached
+    _stats['hits'] += 1
+    entry = _entries.pop(key)
+    _entries[key] = entry
+    return entry
+
+def _remove(key):
+    #caller must hold _lock. Values derived from the entry are removed with it.
+    del _entries[key]
+    del _sizes[key]
+    for derived in [k for k in _entries if _is_derived(k) and k[0] == key]:
+        del _entries[derived]
+        del _sizes[derived]
+
+def _evict(keep):
+    #caller must hold _lock. The entry just loaded is kept even if it alone exceeds the budget.
+    while sum(_sizes.values()) > MAX_BYTES and len(_entries) > 1:
+        oldest = next(iter(_entries))
+        if oldest == keep or (_is_derived(keep) and oldest == keep[0]):
+            break
+        _remove(oldest)
+        _stats['evictions'] += 1
+
+def freeze(df):
+    '''
+    Mark the numpy arrays backing a dataframe as read-only, so that accidental in-place
+    modification of a shared frame raises instead of leaking into other sessions. Column Series that
+    pandas has already cached hold writeable views of the arrays, so the cache is cleared first, and
+    columns accessed later are views of the read-only arrays.
+    '''
+    #pandas 3 has no item cache
+    clear_item_cache = getattr(df, '_clear_item_cache', None)
+    if clear_item_cache is not None:
+        clear_item_cache()
+    mgr = getattr(df, '_mgr', None)
+    if mgr is None:
+        mgr = getattr(df, '_data', None)
+    for blk in getattr(mgr, 'blocks', []):
+        arr = blk.values
+        for attr in ['_ndarray', '_codes']:
+            arr = getattr(arr, attr, arr)
+        if isinstance(arr, np.ndarray):
+            arr.flags.writeable = False
+
+def stats():
+    '''
+    Return a dict of cache hit, miss and eviction counts, along with number of entries,
+    total bytes held, and the byte budget.
+    '''
+    with _lock:
+        out = dict(_stats)
+        out['entries'] = len(_entries)
+        out['bytes'] = sum(_sizes.values())
+        out['max_bytes'] = MAX_BYTES
+    return out
+
+def clear():
+    '''
+    Drop all cached entries and reset statistics.
+    '''
+    with _lock:
+        _entries.clear()
+        _sizes.clear()
+        for k in _stats:
+            _stats[k] = 0
+
+def sidecar_path(path, param=None):
+    '''
+    Return the path of the sidecar file for a source file (and gdx parameter).
+    '''
+    if param is None:
+        return path + '.superpivot.feather'
+    return path + '.' + param + '.superpivot.feather'
+
+def file_hash(path):
+    '''
+    Return the sha1 hex digest of a file's contents.
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def read_sidecar(path, param=None):
+    '''
+    Read the sidecar of a source file, if there is one and it is still valid. A sidecar is valid when
+    the source's mtime and size match those recorded when it was written, or, if only the mtime differs
+    (e.g. the file was touched or copied), when the source's content hash still matches.
+
+    Args:
+        path (string): Path to the source file.
+        param (string, optional): Parameter name, for gdx files.
+
+    Returns:
+        None if there is no valid sidecar, otherwise a tuple of:
+        df_source (pandas dataframe): Cleaned dataframe, with discrete columns as categoricals.
+        cols (dict): Column classification, as stored by write_sidecar().
+    '''
+    side_path = sidecar_path(path, param)
+    if not os.path.isfile(side_path):
+        return None
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as pf
+    except ImportError:
+        return None
+    with pa.memory_map(side_path) as source:
+        meta = json.loads(pa.ipc.open_file(source).schema.metadata[b'superpivot'].decode('utf-8'))
+    stat = os.stat(path)
+    if meta['version'] != SIDECAR_VERSION or meta['size'] != stat.st_size:
+        return None
+    if meta['mtime'] != stat.st_mtime and meta['sha1'] != file_hash(path):
+        return None
+    df_source = pf.read_table(side_path, memory_map=True).to_pandas()
+    return (df_source, meta['cols'])
+
+def write_sidecar(path, param, df_source, cols):
+    '''
+    Write a cleaned dataframe and its column classification to the sidecar of a source file.
+    Discrete columns are stored as categoricals. Failure to write (pyarrow not installed,
+    read-only directory, unsupported column types) is not an error, as the sidecar is only an optimization.
+
+    Args:
+        path (string): Path to the source file.
+        param (string, optional): Parameter name, for gdx files.
+        df_source (pandas dataframe): Cleaned dataframe.
+        cols (dict): Column classification. Must be json serializable.
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as pf
+    except ImportError:
+        return
+    stat = os.stat(path)
+    meta = {'version': SIDECAR_VERSION, 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': file_hash(path), 'cols': cols}
+    df_cat = df_source.copy()
+    for col in cols['discrete']:
+        df_cat[col] = df_cat[col].astype('category')
+    side_path = sidecar_path(path, param)
+    tmp_path = side_path + '.tmp'
+    try:
+        table = pa.Table.from_pandas(df_cat, preserve_index=False)
+        table = table.replace_schema_metadata({b'superpivot': json.dumps(meta).encode('utf-8')})
+        pf.write_feather(table, tmp_path, compression='uncompressed')
+        os.rename(tmp_path, side_path)
+    except (IOError, OSError, pa.ArrowException):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -18,25 +18,16 @@ $(document).ready(function(){
     $('body').on('click', '.filters-dropdown', function(){
         $('.filter-head').toggle();
         $('.filters-update').toggle();
-        $('.select-all-none').hide();
-        $('.filter').hide();
+        $('.filter-editor').hide();
     });
     $('body').on('click', '.filter-head', function(){
-        if($(this).next('.select-all-none').length == 0){
-            $(this).after('<div class="select-all-none"><span class="select-all select-opt">All</span>|<span class="select-none select-opt">None</span>');
-        }else{
-            $(this).next(".select-all-none").toggle();
-        }
-        $(this).next(".select-all-none").next(".filter").toggle();
+        $('.filter-editor').show();
     });
     $('body').on('click', '.adjust-dropdown', function(){
         $('.adjust-drop').toggle();
     });
-    $('body').on('click', '.select-opt', function(){
-        var checked_bool = $(this).hasClass('select-all') ? true: false;
-        $(this).parent().next('.bk-widget').find('.bk-bs-checkbox input').prop( "checked", checked_bool);
-        $(this).parent().next('.bk-widget').find('.bk-bs-checkbox input').first().click();
-        $(this).parent().next('.bk-widget').find('.bk-bs-checkbox input').first().click();
+    $('body').on('click', '.diagnostics-dropdown', function(){
+        $('.diagnostics-drop').toggle();
     });
     $('body').on('click', '.legend-header', function(){
         $(this).next('.legend-body').toggle();
@@ -44,24 +35,31 @@ $(document).ready(function(){
 
     $('body').on('click', '.export-config', function(){
         var wdg_obj = {}
-        $('select, input[type=text]').each(function(){
+        $('select, input[type=text]').not('.filter-search input').each(function(){
             var wdg_name = $(this).parent().attr('class').match(/wdgkey-([^ ]*)/)[1];
             var selected_val = $(this).val();
             wdg_obj[wdg_name] = selected_val;
         });
-        $('.filter').each(function(){
-            var wdg_name = $(this).attr('class').match(/wdgkey-([^ ]*)/)[1];
-            wdg_obj[wdg_name] = []
-            $(this).find('input').each(function(){
-                if($(this).is(":checked")){
-                    wdg_obj[wdg_name].push(parseInt($(this).attr('value')));
-                }
-            });
-        });
+        //filters only exist once a data source is loaded
+        var filter_state = $('.filter-state');
+        if(filter_state.length){
+            wdg_obj['filter_state'] = JSON.parse(filter_state.text());
+        }
         var widgets_string = encodeURIComponent(JSON.stringify(wdg_obj));
         var pathname = window.location.pathname.replace('/',''); //remove just the first slash
         window.history.pushState({}, "", pathname+"?widgets=" + widgets_string);
     });
+    //download each export once its link appears. Widgets may be rendered again, so links already followed are remembered.
+    var exported = {};
+    new MutationObserver(function(){
+        $('.export-link').each(function(){
+            var href = $(this).attr('href');
+            if(!exported[href]){
+                exported[href] = true;
+                this.click();
+            }
+        });
+    }).observe(document.body, {childList: true, subtree: true});
 });
 //pressing Alt key will collapse menus.
 document.onkeydown = function(e) {
@@ -74,8 +72,8 @@ document.onkeydown = function(e) {
     $('.adv-drop').hide();
     $('.filter-head').hide();
     $('.filters-update').hide();
-    $('.select-all-none').hide();
-    $('.filter').hide();
+    $('.filter-editor').hide();
     $('.adjust-drop').hide();
+    $('.diagnostics-drop').hide();
   }
 };
\ No newline at end of file